@@ -0,0 +1,320 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Let services move themselves to a new root, rather than be ptraced.
+
+A service opts in by listening on the abstract unix socket named by
+`socket_address()` for its pid, which CooperativeService does:
+
+    service = CooperativeService(on_migrated=reopen_log_files)
+    service.serve_in_thread()
+
+or, for a service with an event loop, by calling `service.handle()` when
+`service.fileno()` is readable.
+
+To migrate it, a JSON request {"op": "migrate"} is sent with an open fd of
+the directory that should be its new root. The service chroots to it,
+changes to the same working directory and reopens its directory fds there,
+or to the "cwd" and [fd, path] "dir_fds" the request gives, as when it's
+moved back, then replies with {"ok": ..., "changed": ..., "problems": [...]}, where
+"changed" is false if it didn't move at all, so it can still be ptraced
+instead. It's never stopped, and neither ptrace nor a permissive yama
+scope are needed, though the service needs CAP_SYS_CHROOT.
+
+Both ends check who the other is with SO_PEERCRED: the service only accepts
+requests from `allowed_uids`, and the migrator only sends to the pid the
+socket is named for. Abstract sockets belong to network namespaces, so a
+service in a different one from the migrator is ptraced as usual.
+
+'''
+
+
+import contextlib
+import errno
+import json
+import logging
+import os
+import socket
+import warnings
+
+from .migrate_process import (get_pid_root, get_pid_cwd, get_pid_dir_fds,
+                              get_pid_starttime, _escaped_path)
+from .ll.scm_rights import send_fds, recv_fds, peer_credentials
+
+
+__all__ = ('socket_address', 'CooperativeService', 'migrate_cooperatively',
+           'revert_cooperatively', 'CooperativeMoveFailed')
+
+
+O_DIRECTORY = 0200000
+
+# How long to wait for a service to move, which it should do immediately
+default_timeout = 10.0
+
+
+def socket_address(pid):
+    '''Return the abstract unix socket address a cooperative `pid` uses.'''
+    return '\0migratelib/cooperative/%d' % pid
+
+
+def _dir_fds():
+    fds_dir = '/proc/self/fd'
+    for fileno in os.listdir(fds_dir):
+        fd_link = os.path.join(fds_dir, fileno)
+        try:
+            if os.path.isdir(fd_link):
+                yield int(fileno), os.readlink(fd_link)
+        except OSError as e:
+            # Such as the fd listdir used, which is closed by now
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class CooperativeService(object):
+    '''Listen for requests to move this process to a new root.
+
+    `on_migrated` is called after moving, so the service can reopen any
+    other files it should. Only requests from processes running as a uid
+    in `allowed_uids` are accepted.
+
+    '''
+    def __init__(self, on_migrated=None, allowed_uids=(0,)):
+        self.on_migrated = on_migrated
+        self.allowed_uids = frozenset(allowed_uids)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socket_address(os.getpid()))
+        self.sock.listen(4)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _move(self, root_fd, cwd=None, dir_fds=None):
+        if cwd is None:
+            try:
+                cwd = os.getcwd()
+            except OSError:
+                # Removed, so there's nothing to change back to
+                cwd = '/'
+        if dir_fds is None:
+            dir_fds = [(fd, path) for fd, path in _dir_fds() if fd != root_fd]
+        try:
+            os.fchdir(root_fd)
+            os.chroot('.')
+        except OSError as e:
+            os.chdir(cwd)
+            return {'ok': False, 'changed': False, 'error': str(e)}
+        # Moved, so whatever goes wrong now is a problem to report rather
+        # than a reason to be migrated again
+        problems = []
+        for fd, path in dir_fds:
+            try:
+                new_fd = os.open(path, os.O_RDONLY | O_DIRECTORY)
+                try:
+                    os.dup2(new_fd, fd)
+                finally:
+                    os.close(new_fd)
+            except OSError as e:
+                problems.append('fd %d: %s' % (fd, e))
+        try:
+            os.chdir(cwd)
+        except OSError as e:
+            problems.append('cwd: %s' % e)
+        if self.on_migrated is not None:
+            try:
+                self.on_migrated()
+            except Exception as e:
+                logging.exception('on_migrated failed after moving')
+                problems.append('on_migrated: %s' % e)
+        return {'ok': True, 'changed': True, 'problems': problems}
+
+    def _handle(self, conn):
+        pid, uid, gid = peer_credentials(conn)
+        if uid not in self.allowed_uids:
+            logging.warning('Refusing migration request from pid %d, '
+                            'running as uid %d' % (pid, uid))
+            return {'ok': False, 'changed': False,
+                    'error': 'uid %d is not allowed' % uid}
+        data, fds = recv_fds(conn.fileno(), 4096, 1)
+        try:
+            request = json.loads(data)
+            if request.get('op') != 'migrate' or len(fds) != 1:
+                raise ValueError('expected a migrate request and a root fd')
+            # Where to be in the new root, when we can't tell ourselves, as
+            # after the old root was pivoted back to
+            cwd = request.get('cwd')
+            dir_fds = request.get('dir_fds')
+            return self._move(fds[0],
+                              cwd=str(cwd) if cwd is not None else None,
+                              dir_fds=[(int(fd), str(path))
+                                       for fd, path in dir_fds]
+                                      if dir_fds is not None else None)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def handle(self):
+        '''Accept and handle one request.'''
+        conn, _ = self.sock.accept()
+        with contextlib.closing(conn):
+            try:
+                reply = self._handle(conn)
+            except Exception as e:
+                # Anything that gets here happened before moving
+                logging.exception('Handling a migration request failed')
+                reply = {'ok': False, 'changed': False, 'error': str(e)}
+            try:
+                conn.sendall(json.dumps(reply) + '\n')
+            except socket.error as e:
+                logging.warning('Could not reply to a migration request: %s'
+                                % e)
+
+    def serve_forever(self):
+        while True:
+            self.handle()
+
+    def serve_in_thread(self):
+        '''Handle requests in a daemon thread.'''
+        import threading
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='migratelib-cooperative')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        self.sock.close()
+
+
+class CooperativeMoveFailed(Exception):
+    '''A process was sent its new root but may not have moved properly.
+
+    `record` is what migrate_cooperatively would have returned, which
+    should be kept so the process can be reverted, since it may have moved.
+
+    '''
+    def __init__(self, message, record):
+        Exception.__init__(self, message)
+        self.record = record
+
+
+def _connect(pid, timeout):
+    '''Connect to `pid`'s cooperative socket, or return None if it isn't
+    listening.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_address(pid))
+        peer_pid, _, _ = peer_credentials(sock)
+    except socket.timeout:
+        sock.close()
+        warnings.warn('Timed out connecting to the cooperative socket of '
+                      'pid %d' % pid)
+        return None
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            return None
+        raise
+    if peer_pid != pid:
+        sock.close()
+        warnings.warn('Cooperative socket of pid %d belongs to pid %d'
+                      % (pid, peer_pid))
+        return None
+    return sock
+
+
+def _send_move(sock, root, request):
+    root_fd = os.open(root, os.O_RDONLY | O_DIRECTORY)
+    try:
+        send_fds(sock.fileno(), json.dumps(request), [root_fd])
+    finally:
+        os.close(root_fd)
+
+
+def _read_reply(sock, pid):
+    reply = sock.makefile().readline()
+    if not reply:
+        raise Exception('Pid %d closed its cooperative socket without '
+                        'replying' % pid)
+    return json.loads(reply)
+
+
+def migrate_cooperatively(pid, new_root, timeout=default_timeout):
+    '''Ask `pid` to move its root, cwd and directory fds into `new_root`.
+
+    `new_root` is a copy of our root, as for migrate_process, which this
+    returns the same kind of record as. None is returned if `pid` doesn't
+    cooperate, or didn't move, so it can be migrated by ptrace instead.
+
+    Once the new root has been sent, the process may have moved, so if it
+    then fails or doesn't reply in `timeout` seconds, CooperativeMoveFailed
+    is raised with its record.
+
+    '''
+    sock = _connect(pid, timeout)
+    if sock is None:
+        return None
+    with contextlib.closing(sock):
+        old_root = get_pid_root(pid)
+        pid_new_root = os.path.normpath(os.path.join(new_root,
+                                                     old_root.lstrip('/')))
+        record = {'pid': pid, 'starttime': get_pid_starttime(pid),
+                  'old_root': old_root, 'old_cwd': get_pid_cwd(pid),
+                  'old_dir_fds': tuple(get_pid_dir_fds(pid)),
+                  'new_root': pid_new_root,
+                  'steps': [('cooperative', pid_new_root)]}
+        try:
+            _send_move(sock, pid_new_root, {'op': 'migrate'})
+        except (socket.error, OSError) as e:
+            warnings.warn('Could not ask pid %d to move itself: %s' % (pid, e))
+            return None
+        try:
+            reply = _read_reply(sock, pid)
+        except Exception as e:
+            raise CooperativeMoveFailed('Pid %d may not have moved itself: %s'
+                                        % (pid, e), record)
+    if not reply.get('changed'):
+        warnings.warn('Pid %d did not move itself: %s'
+                      % (pid, reply.get('error')))
+        return None
+    if not reply.get('ok'):
+        raise CooperativeMoveFailed('Pid %d failed to move itself: %s'
+                                    % (pid, reply.get('error')), record)
+    for problem in reply.get('problems', ()):
+        warnings.warn('Pid %d moved with a problem: %s' % (pid, problem))
+    return record
+
+
+def revert_cooperatively(record, timeout=default_timeout):
+    '''Ask a process moved by migrate_cooperatively to move back.'''
+    pid = record['pid']
+    sock = _connect(pid, timeout)
+    if sock is None:
+        raise Exception('Pid %d is no longer listening to be reverted' % pid)
+    old_root = record['old_root']
+    # Its own idea of its cwd is wrong once the old root was pivoted back
+    # to, as it's then in the detached new tree
+    request = {'op': 'migrate',
+               'cwd': os.path.join('/', os.path.relpath(record['old_cwd'],
+                                                        old_root)),
+               'dir_fds': [(fileno, _escaped_path(path))
+                           for fileno, path in record['old_dir_fds']]}
+    with contextlib.closing(sock):
+        _send_move(sock, _escaped_path(old_root), request)
+        reply = _read_reply(sock, pid)
+    if not reply.get('ok'):
+        raise Exception('Reverting root of pid %d failed: %s'
+                        % (pid, reply.get('error')))
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Serve migration requests over a unix socket, keeping state warm.
+
+Requests and responses are JSON objects, one per line. Every request has an
+"op" field, one of:
+
+status
+    Report what namespaces and roots are known.
+refresh
+    Re-scan /proc for processes.
+plan
+    Report the mounts that would be made, without changing anything.
+migrate
+    Migrate a namespace to a new root. If "retain" is true, then the old
+    roots are kept until a revert or commit request. If "prewarm_budget"
+    is given, then up to that many bytes of the new root are read into
+    the page cache before processes are migrated.
+revert
+    Move a namespace and its processes back to the old roots retained by
+    the last migration.
+commit
+    Release the old roots retained by the last migration.
+
+plan and migrate take a "replace" field, which is a list of arguments in the
+same format as the command-line `--replace` options, and select the
+namespace with either a "namespace" field containing the namespace's inode
+number, or a "pid" field of a process in that namespace. The processes
+migrated can be restricted with "cgroup" and "exe" fields, which are lists
+of cgroup v2 paths and executables, like the command-line options. If
+they leave out processes in the roots being migrated, migrate refuses
+unless a "force" field is true.
+
+migrate and revert fail at once if another migration of the same namespace
+is running, unless a "lock_wait" field gives how many seconds to wait for it.
+
+'''
+
+
+import argparse
+import errno
+import json
+import logging
+import os
+import socket
+import SocketServer
+import tempfile
+import time
+
+from .genmounts import plan_mount_commands
+from .list_processes import ProcessIndex, select_pids, check_selection
+from .locking import MigrationLocks, default_lock_dir
+from .migrate_process import CapabilityCache
+from .migrate_namespace import (migrate_namespace, namespace_snapshot,
+                                find_root_mounts, group_nested_roots)
+from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
+from .staging import list_staged
+from .strategy import TreeStrategy
+from . import replaceparser
+
+
+__all__ = ('MigrationDaemon', 'send_request')
+
+
+default_socket_path = '/run/migratelib.sock'
+
+
+class RequestError(Exception):
+    pass
+
+
+class _RequestArgumentParser(argparse.ArgumentParser):
+    # argparse exits the process on errors, which is unhelpful in a daemon
+    def error(self, message):
+        raise RequestError(message)
+
+
+class MigrationDaemon(object):
+    '''Handle migration requests, keeping process information and commands.
+
+    The *_cmd arguments are kept for the lifetime of the daemon, so the
+    canned equivalents only need to be prepared once, and so are the
+    capabilities of executables that have been probed.
+
+    Roots are locked in `lock_dir` while they're migrated, unless it's None.
+
+    '''
+    def __init__(self, mount_cmd=mount_cmd, umount_cmd=umount_cmd,
+                 findmnt_cmd=findmnt_cmd, lock_dir=default_lock_dir):
+        self.mount_cmd = mount_cmd
+        self.umount_cmd = umount_cmd
+        self.findmnt_cmd = findmnt_cmd
+        self.index = ProcessIndex()
+        self.index.refresh()
+        self.started = time.time()
+        self.migrations = 0
+        self.retained = {} # namespace inode -> {root: RetainedRoot}
+        self.caps = CapabilityCache()
+        self.strategy = TreeStrategy()
+        self.lock_dir = lock_dir
+
+    def locks(self, request):
+        # Waiting holds up every other request, so don't by default
+        return MigrationLocks(lock_dir=self.lock_dir,
+                              timeout=request.get('lock_wait', 0))
+
+    def parse_replacements(self, argv):
+        ap = _RequestArgumentParser()
+        replaceparser.extend_arg_parser(ap)
+        return ap.parse_args([str(arg) for arg in argv]).replace
+
+    def find_namespace(self, request):
+        if 'namespace' in request:
+            inode = int(request['namespace'])
+            if inode not in self.index.namespaces:
+                raise RequestError('Unknown namespace %d' % inode)
+            return self.index.namespaces[inode]
+        pid = int(request.get('pid', os.getpid()))
+        if pid not in self.index.pids:
+            raise RequestError('Unknown pid %d' % pid)
+        return self.index.namespace_of(pid)
+
+    def pids_in_root(self, namespace, request):
+        pids_in_root = self.index.procinfo[namespace]
+        selected = select_pids(cgroups=request.get('cgroup', ()),
+                               executables=request.get('exe', ()))
+        if selected is None:
+            return pids_in_root
+        return dict((root, pids & selected)
+                    for root, pids in pids_in_root.iteritems()
+                    if pids & selected)
+
+    def selected_pids_in_root(self, namespace, request):
+        pids_in_root = self.pids_in_root(namespace, request)
+        if request.get('cgroup') or request.get('exe'):
+            check_selection(namespace, pids_in_root,
+                            force=request.get('force', False))
+        return pids_in_root
+
+    def status(self, request):
+        procinfo = self.index.procinfo
+        return {
+            'uptime': time.time() - self.started,
+            'migrations': self.migrations,
+            'retained': dict((str(inode), sorted(roots))
+                             for inode, roots in self.retained.iteritems()),
+            'namespaces': dict(
+                (str(ns.inode), dict((root, len(pids))
+                                     for root, pids in roots.iteritems()))
+                for ns, roots in procinfo.iteritems()),
+        }
+
+    def refresh(self, request):
+        start = time.time()
+        self.index.refresh()
+        return {'pids': len(self.index.pids),
+                'namespaces': len(self.index.namespaces),
+                'duration': time.time() - start}
+
+    def staged_trees(self, namespace):
+        # Left out of migrations, as staging.migrate_staged pivots to them
+        return [staged['tree'] for staged in list_staged(namespace=namespace)]
+
+    def plan(self, request):
+        replacements = self.parse_replacements(request.get('replace', ()))
+        namespace = self.find_namespace(request)
+        pids_in_root = group_nested_roots(self.pids_in_root(namespace,
+                                                            request))
+        exclude = self.staged_trees(namespace)
+        roots = {}
+        with namespace.entered():
+            # Where migrate would make the new tree, which isn't made here
+            new_root = os.path.join(tempfile.gettempdir(), 'new-tree')
+            snapshot = namespace_snapshot(namespace,
+                                          findmnt_cmd=self.findmnt_cmd)
+            for root, pids in pids_in_root.iteritems():
+                mount_list = find_root_mounts(snapshot, root, exclude=exclude)
+                mounts = plan_mount_commands(mount_list=mount_list,
+                                             replace=replacements,
+                                             new_root=new_root,
+                                             exclude=exclude)
+                roots[root] = {'pids': sorted(pids),
+                               'mounts': [m.argv for m in mounts]}
+        return {'namespace': namespace.inode, 'new_root': new_root,
+                'exclude': exclude, 'roots': roots}
+
+    def migrate(self, request):
+        replacements = self.parse_replacements(request.get('replace', ()))
+        self.index.refresh()
+        namespace = self.find_namespace(request)
+        if namespace.inode in self.retained:
+            raise RequestError('Namespace %d has a retained old root, '
+                               'revert or commit it first' % namespace.inode)
+        retained = {} if request.get('retain') else None
+        start = time.time()
+        try:
+            migrated = migrate_namespace(
+                namespace=namespace,
+                pids_in_root=self.selected_pids_in_root(namespace, request),
+                replacements=replacements, mount_cmd=self.mount_cmd,
+                umount_cmd=self.umount_cmd, findmnt_cmd=self.findmnt_cmd,
+                retained=retained,
+                prewarm_budget=request.get('prewarm_budget'),
+                exclude=self.staged_trees(namespace),
+                caps=self.caps, strategy=self.strategy,
+                locks=self.locks(request))
+        finally:
+            # Roots retained before a failure can still be reverted, and
+            # their old trees must be released by commit if not
+            if retained:
+                self.retained[namespace.inode] = retained
+            # Failed methods are worth remembering too, but not at the cost
+            # of hiding why the migration failed
+            try:
+                self.strategy.save()
+            except (IOError, OSError) as e:
+                logging.warning('Could not save strategy history to %s: %s'
+                                % (self.strategy.history_path, e))
+        self.migrations += 1
+        # Every process we migrated now has a different root
+        self.index.refresh()
+        return {'namespace': namespace.inode, 'migrated': migrated,
+                'duration': time.time() - start}
+
+    def _retained(self, request):
+        namespace = self.find_namespace(request)
+        try:
+            return namespace, self.retained[namespace.inode]
+        except KeyError:
+            raise RequestError('Namespace %d has no retained old root'
+                               % namespace.inode)
+
+    def revert(self, request):
+        namespace, retained = self._retained(request)
+        roots = sorted(retained)
+        locks = self.locks(request)
+        with locks.namespace(namespace.inode), \
+             locks.roots(namespace.inode, roots), \
+             namespace.entered():
+            for root in roots:
+                retained[root].revert(umount_cmd=self.umount_cmd,
+                                      findmnt_cmd=self.findmnt_cmd)
+                # Only forgotten once reverted, so a failure can be retried
+                # or committed
+                del retained[root]
+        del self.retained[namespace.inode]
+        self.index.refresh()
+        return {'namespace': namespace.inode, 'reverted': roots}
+
+    def commit(self, request):
+        namespace, retained = self._retained(request)
+        del self.retained[namespace.inode]
+        for retained_root in retained.itervalues():
+            retained_root.commit()
+        return {'namespace': namespace.inode, 'committed': sorted(retained)}
+
+    ops = {
+        'status': status,
+        'refresh': refresh,
+        'plan': plan,
+        'migrate': migrate,
+        'revert': revert,
+        'commit': commit,
+    }
+
+    def handle(self, request):
+        try:
+            op = self.ops[request['op']]
+        except KeyError:
+            return {'error': 'Unknown op %r' % request.get('op')}
+        try:
+            return {'result': op(self, request)}
+        except Exception as e:
+            logging.exception('Request %r failed' % request)
+            return {'error': str(e)}
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': 'Malformed request: %s' % e}
+            else:
+                response = self.server.migration_daemon.handle(request)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class _UnixServer(SocketServer.UnixStreamServer):
+    def __init__(self, path, daemon):
+        self.migration_daemon = daemon
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+
+
+def serve(daemon, path=default_socket_path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    old_umask = os.umask(0077)
+    try:
+        server = _UnixServer(path, daemon)
+    finally:
+        os.umask(old_umask)
+    logging.info('Listening on %s' % path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def send_request(request, path=default_socket_path):
+    '''Send a request to a running daemon and return its response.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        fobj = sock.makefile('r+')
+        fobj.write(json.dumps(request) + '\n')
+        fobj.flush()
+        return json.loads(fobj.readline())
+    finally:
+        sock.close()
+
+
+def run():
+    import sys
+    from .canned_command_runner import (root_fd, canned_mount_cmd,
+                                        canned_umount_cmd, canned_findmnt_cmd)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--socket', default=default_socket_path)
+    ap.add_argument('--lock-dir', default=default_lock_dir,
+                    help='Directory of lock files, which must be shared '
+                         'with every other migration on the host')
+    opts = ap.parse_args()
+
+    with root_fd() as root_fdno, \
+         canned_mount_cmd(root_fdno) as mount_cmd, \
+         canned_umount_cmd(root_fdno) as umount_cmd, \
+         canned_findmnt_cmd(root_fdno) as findmnt_cmd:
+        daemon = MigrationDaemon(mount_cmd=mount_cmd, umount_cmd=umount_cmd,
+                                 findmnt_cmd=findmnt_cmd,
+                                 lock_dir=opts.lock_dir)
+        serve(daemon, path=opts.socket)
+
+
+if __name__ == '__main__':
+    run()
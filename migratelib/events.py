@@ -0,0 +1,194 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Report migration progress as a stream of JSON events.
+
+Each event is a JSON object on its own line, with an "event" field naming
+it and a "time" field. Events are:
+
+scan-complete
+    Processes have been listed, with "namespaces" and "pids" counts.
+namespace-entered
+    Migration of "namespace" started, with "pids" to migrate.
+mounts-planned
+    The new tree for "root" needs "mounts" mounts.
+strategy
+    The bind mounts of the new tree for "root" will be made by "method",
+    and the old tree torn down by "teardown", because of "reason".
+mounts-created
+    The new tree for "root" has been mounted, taking "duration" seconds,
+    with bind mounts last made by "method".
+prewarm
+    Files "root"'s processes use were read from its new tree, within
+    "budget" bytes: "files" files and "bytes" bytes were loaded, and
+    "skipped" files were over budget, "missing" not in the new tree and
+    "failed" unreadable.
+pid-migrated, pid-skipped, pid-failed
+    A process has been dealt with. These include "done" and "total" counts,
+    "rate" in processes per second and "eta" in seconds, when known.
+    pid-migrated has the "method" used, "cooperative" or "ptrace".
+verified
+    "checked" migrated processes in "root" have been checked, of which
+    "exited" had exited, and "stragglers" maps the pids of those not
+    entirely in the new tree to what isn't.
+throttle
+    Pressure on the host changed how fast to go, to pausing for "delay"
+    seconds before each step and using "concurrency" workers. "pressure"
+    is the percentage of time tasks stalled on each resource, and "over"
+    lists those over their limits.
+pivot
+    "root" has been pivoted into its new tree.
+teardown
+    The old tree of "root" has been detached.
+complete
+    The migration has finished, and "dropped" events were not sent. "ok"
+    is false if it failed, with the exception's type and message in
+    "error". If throttled, "throttle" summarises what was done, as
+    Throttle.summary.
+
+'''
+
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+
+
+__all__ = ('EventStream',)
+
+
+F_SETPIPE_SZ = 1031
+# Writes to a pipe up to this size are never split
+PIPE_BUF = 4096
+
+
+def _relay(read_fd, write_fd):
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            return
+        while data:
+            data = data[os.write(write_fd, data):]
+
+
+class EventStream(object):
+    '''Send events to `fobj`, which is a file object or socket.
+
+    Events are passed through a pipe to a separate process, which writes
+    them to `fobj`, so a slow reader can't stall the migration. If the pipe
+    has `buffer_size` bytes waiting, further events are dropped and counted
+    instead. A process is used rather than a thread, since a process with
+    threads can't enter other mount namespaces.
+
+    If `fobj` is None then events are discarded, so an EventStream can
+    always be passed.
+
+    '''
+    def __init__(self, fobj=None, buffer_size=1024*1024):
+        self.dropped = 0
+        self.pids_total = 0
+        self.pids_done = 0
+        self.pids_started = None
+        self.pipe_fd = None
+        self.relay_pid = None
+        if fobj is None:
+            return
+        read_fd, write_fd = os.pipe()
+        try:
+            fcntl.fcntl(write_fd, F_SETPIPE_SZ, buffer_size)
+        except IOError as e:
+            # Larger than /proc/sys/fs/pipe-max-size, stick with the default
+            if e.errno != errno.EPERM:
+                raise
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(write_fd)
+                _relay(read_fd, fobj.fileno())
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(read_fd)
+        flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        fcntl.fcntl(write_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.pipe_fd = write_fd
+        self.relay_pid = pid
+
+    def emit(self, event, **fields):
+        if self.pipe_fd is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        data = json.dumps(fields) + '\n'
+        if len(data) > PIPE_BUF:
+            # Could be split by other writes, so would corrupt the stream
+            self.dropped += 1
+            return
+        try:
+            os.write(self.pipe_fd, data)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                self.dropped += 1
+            elif e.errno == errno.EPIPE:
+                # Nobody is listening, so stop trying
+                logging.warning('Event reader went away')
+                self._close_pipe()
+            else:
+                raise
+
+    def _close_pipe(self):
+        os.close(self.pipe_fd)
+        self.pipe_fd = None
+
+    def expect_pids(self, count):
+        '''Add `count` to the number of pids that will be dealt with.'''
+        self.pids_total += count
+
+    def pid_starting(self):
+        '''Note that dealing with pids has started, for throughput.'''
+        if self.pids_started is None:
+            self.pids_started = time.time()
+
+    def pid_finished(self, pid, outcome, **fields):
+        '''Emit a pid-`outcome` event, with throughput and ETA.'''
+        now = time.time()
+        if self.pids_started is None:
+            self.pids_started = now
+        self.pids_done += 1
+        elapsed = now - self.pids_started
+        rate = eta = None
+        if elapsed > 0:
+            rate = self.pids_done / elapsed
+            if self.pids_total >= self.pids_done:
+                eta = (self.pids_total - self.pids_done) / rate
+        self.emit('pid-' + outcome, pid=pid, done=self.pids_done,
+                  total=self.pids_total, rate=rate, eta=eta, **fields)
+
+    def close(self, **fields):
+        '''Emit the complete event with `fields`, and wait for the rest to
+        be written.'''
+        self.emit('complete', dropped=self.dropped, **fields)
+        if self.pipe_fd is not None:
+            self._close_pipe()
+        if self.relay_pid is not None:
+            os.waitpid(self.relay_pid, 0)
+            self.relay_pid = None
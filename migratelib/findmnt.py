@@ -17,13 +17,15 @@
 'Find information about mounts'
 
 
+import collections
 import shlex
 import subprocess
 
 from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
+from .profiling import phase
 
 
-__all__ = ('search_fields', 'find_mounts')
+__all__ = ('search_fields', 'find_mounts', 'MountSnapshot')
 
 
 search_fields = [
@@ -41,6 +43,7 @@ search_fields = [
        'FSROOT', # filesystem root
           'TID', # task ID
            'ID', # mount ID
+       'PARENT', # mount parent ID
    'OPT-FIELDS', # optional mount fields
   'PROPAGATION', # VFS propagation flags
 ]
@@ -48,26 +51,87 @@ search_fields = [
 
 def find_mounts(root=None, tab_file=None, task=None, fields=None,
                 recurse=False, runcmd=findmnt_cmd):
-    argv = ['--pairs', '--nofsroot']
-    if task is not None:
-        argv.extend(('--task', str(task)))
-    if tab_file is not None:
-        argv.extend(('--tab-file', str(tab_file)))
-    if fields is not None:
-        argv.extend(('--output', ','.join(fields)))
-    if recurse:
-        if root is None:
-            raise ValueError('recurse passed without root')
-        argv.append('--submounts')
-    if root is not None:
-        argv.append(root)
-    o = runcmd(argv)
-
-    mount_list = []
-    for line in o.splitlines():
-        matches = dict()
-        for pair in shlex.split(line):
-            key, value = pair.split('=', 1)
-            matches[key] = value.decode('string_escape')
-        mount_list.append(matches)
+    with phase('findmnt'):
+        argv = ['--pairs', '--nofsroot']
+        if task is not None:
+            argv.extend(('--task', str(task)))
+        if tab_file is not None:
+            argv.extend(('--tab-file', str(tab_file)))
+        if fields is not None:
+            argv.extend(('--output', ','.join(fields)))
+        if recurse:
+            if root is None:
+                raise ValueError('recurse passed without root')
+            argv.append('--submounts')
+        if root is not None:
+            argv.append(root)
+        o = runcmd(argv)
+
+        mount_list = []
+        for line in o.splitlines():
+            matches = dict()
+            for pair in shlex.split(line):
+                key, value = pair.split('=', 1)
+                matches[key] = value.decode('string_escape')
+            mount_list.append(matches)
     return mount_list
+
+
+class MountSnapshot(object):
+    '''The mount table of a namespace, read once and queried many times.
+
+    The table is only re-read after `invalidate()` is called, which should
+    be done after changing mounts, so lookups between changes cost no
+    findmnt calls.
+
+    '''
+    def __init__(self, tab_file=None, task=None, runcmd=findmnt_cmd):
+        self.tab_file = tab_file
+        self.task = task
+        self.runcmd = runcmd
+        self._mounts = None
+
+    def invalidate(self):
+        self._mounts = None
+
+    @property
+    def mounts(self):
+        if self._mounts is None:
+            self._mounts = find_mounts(tab_file=self.tab_file, task=self.task,
+                                       fields=search_fields,
+                                       runcmd=self.runcmd)
+            self._children = collections.defaultdict(list)
+            for mount in self._mounts:
+                if mount['PARENT'] != mount['ID']:
+                    self._children[mount['PARENT']].append(mount)
+        return self._mounts
+
+    def mount_at(self, target):
+        '''Return the visible mount at `target`, or None.'''
+        # Later mounts at the same target are mounted over earlier ones
+        for mount in reversed(self.mounts):
+            if mount['TARGET'] == target:
+                return mount
+        return None
+
+    def submounts(self, root, exclude=()):
+        '''List the mount at `root` and all mounts under it, parents first.
+
+        This is equivalent to `find_mounts(root=root, recurse=True)`, except
+        that mounts at targets in `exclude`, and mounts under them, are left
+        out.
+
+        '''
+        root_mount = self.mount_at(root)
+        if root_mount is None:
+            raise ValueError('%s is not a mount point' % root)
+        exclude = frozenset(exclude)
+        mount_list = []
+        to_visit = [root_mount]
+        while to_visit:
+            mount = to_visit.pop()
+            if mount['TARGET'] in exclude:
+                continue
+            mount_list.append(mount)
+            to_visit.extend(reversed(self._children[mount['ID']]))
+        return mount_list
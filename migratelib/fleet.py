@@ -0,0 +1,444 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Roll a migration out across many hosts in waves.
+
+Each host runs migrate_namespace with its progress events written to its
+stdout, through a transport, which is how a command gets run on a host.
+LocalTransport runs every host's command on this machine, which is useful
+for testing with simulated hosts, and SSHTransport runs it over ssh.
+
+Hosts are split into waves, the first of which is a wave of canaries. No
+more than `parallel` hosts are migrated at once, and a wave doesn't start
+until the one before has finished. If a canary fails, or more than
+`max_failure_rate` of all the hosts have failed, then no more hosts are
+started, though those already running are left to finish, since
+stopping a host part way through a migration is worse than letting it
+complete.
+
+The coordinator's own events, when it's given an EventStream, are:
+
+host-started
+    The migration of "host" was started in "wave".
+host-finished
+    "host" finished with "status", after "duration" seconds.
+halted
+    No more hosts will be started, because of "reason".
+
+'''
+
+
+import collections
+import errno
+import json
+import logging
+import os
+import pipes
+import select
+import subprocess
+import sys
+import time
+
+from .events import EventStream
+
+
+__all__ = ('LocalTransport', 'SSHTransport', 'HostResult', 'FleetReport',
+           'plan_waves', 'roll_out')
+
+
+default_command = ('python', '-m', 'migratelib.migrate_namespace',
+                   '--events-fd', '1')
+
+
+class LocalTransport(object):
+    '''Run every host's command on this machine.
+
+    The host's name is passed in the MIGRATELIB_FLEET_HOST environment
+    variable, so a command can tell the simulated hosts apart.
+
+    '''
+    def start(self, host, argv):
+        env = dict(os.environ)
+        env['MIGRATELIB_FLEET_HOST'] = host
+        return subprocess.Popen(argv, stdin=open(os.devnull),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env,
+                                close_fds=True)
+
+
+class SSHTransport(object):
+    '''Run each host's command with ssh, passing it `ssh_options`.'''
+    def __init__(self, ssh_options=(), ssh_cmd='ssh'):
+        self.ssh_options = list(ssh_options)
+        self.ssh_cmd = ssh_cmd
+
+    def start(self, host, argv):
+        # ssh joins its arguments into a shell command on the other side
+        command = ' '.join(pipes.quote(arg) for arg in argv)
+        return subprocess.Popen([self.ssh_cmd, '-o', 'BatchMode=yes']
+                                + self.ssh_options + [host, command],
+                                stdin=open(os.devnull),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+
+
+class HostResult(object):
+    '''What happened on one host, gathered from its events.'''
+
+    # Lines of stderr kept to explain a failure
+    stderr_lines = 20
+
+    def __init__(self, host, wave):
+        self.host = host
+        self.wave = wave
+        self.status = 'not-started'
+        self.returncode = None
+        self.started = None
+        self.duration = None
+        self.namespaces = 0
+        self.mounts = 0
+        self.mount_time = 0.0
+        self.pids = {}
+        self.errors = {}
+        self.dropped = 0
+        self.throttle = None
+        self.bad_lines = 0
+        self.stderr = collections.deque(maxlen=self.stderr_lines)
+
+    def add_event(self, event):
+        name = event.get('event')
+        if name == 'namespace-entered':
+            self.namespaces += 1
+        elif name == 'mounts-created':
+            self.mounts += event.get('mounts', 0)
+            self.mount_time += event.get('duration', 0.0)
+        elif name is not None and name.startswith('pid-'):
+            pid = event.get('pid')
+            self.pids[pid] = name[len('pid-'):]
+            if 'error' in event:
+                self.errors[pid] = event['error']
+        elif name == 'complete':
+            self.dropped = event.get('dropped', 0)
+            self.throttle = event.get('throttle')
+
+    def as_dict(self):
+        return {
+            'host': self.host,
+            'wave': self.wave,
+            'status': self.status,
+            'returncode': self.returncode,
+            'duration': self.duration,
+            'namespaces': self.namespaces,
+            'mounts': self.mounts,
+            'mount_time': self.mount_time,
+            'pids': dict(collections.Counter(self.pids.itervalues())),
+            'errors': dict((str(pid), error)
+                           for pid, error in self.errors.iteritems()),
+            'dropped_events': self.dropped,
+            'throttle': self.throttle,
+            'stderr': list(self.stderr) if self.status == 'failed' else [],
+        }
+
+
+class FleetReport(object):
+    '''Results of a roll-out, with a HostResult for every host.'''
+
+    def __init__(self, results):
+        self.results = results
+        self.halted = None
+
+    def by_status(self):
+        statuses = collections.defaultdict(list)
+        for result in self.results:
+            statuses[result.status].append(result.host)
+        return dict(statuses)
+
+    def as_dict(self):
+        durations = sorted(result.duration for result in self.results
+                           if result.duration is not None)
+        pids = collections.Counter()
+        for result in self.results:
+            pids.update(result.pids.itervalues())
+        return {
+            'halted': self.halted,
+            'hosts': self.by_status(),
+            'pids': dict(pids),
+            'duration': {
+                'median': durations[len(durations) // 2] if durations
+                          else None,
+                'max': durations[-1] if durations else None,
+            },
+            'results': [result.as_dict() for result in self.results],
+        }
+
+
+def plan_waves(hosts, canaries=1, wave_size=None):
+    '''Split `hosts` into a wave of `canaries`, then waves of `wave_size`.
+
+    If `wave_size` is None, all hosts after the canaries are one wave.
+
+    '''
+    hosts = list(hosts)
+    waves = []
+    if canaries > 0:
+        waves.append(hosts[:canaries])
+        hosts = hosts[canaries:]
+    if wave_size is None:
+        wave_size = len(hosts)
+    for i in xrange(0, len(hosts), max(wave_size, 1)):
+        waves.append(hosts[i:i + wave_size])
+    return [wave for wave in waves if wave]
+
+
+class _Running(object):
+    def __init__(self, result, process):
+        self.result = result
+        self.process = process
+        self.partial = {process.stdout.fileno(): '',
+                        process.stderr.fileno(): ''}
+
+    def fds(self):
+        return self.partial.keys()
+
+    def read(self, fd):
+        '''Handle output on `fd`, returning False at the end of it.'''
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return True
+            raise
+        lines = (self.partial[fd] + data).split('\n')
+        if data:
+            self.partial[fd] = lines.pop()
+        else:
+            # Keep an unterminated last line
+            del self.partial[fd]
+            lines = [line for line in lines if line]
+        for line in lines:
+            if fd == self.process.stdout.fileno():
+                self._event_line(line)
+            else:
+                self.result.stderr.append(line)
+        return bool(data)
+
+    def _event_line(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            self.result.bad_lines += 1
+            return
+        if isinstance(event, dict):
+            self.result.add_event(event)
+        else:
+            self.result.bad_lines += 1
+
+
+def roll_out(hosts, transport, argv=default_command, canaries=1,
+             wave_size=None, parallel=10, max_failure_rate=0.1, events=None):
+    '''Run `argv` on each of `hosts` through `transport`, in waves.
+
+    Returns a FleetReport. Its `halted` is the reason no more hosts were
+    started, or None if every host was.
+
+    '''
+    if events is None:
+        events = EventStream()
+    waves = plan_waves(hosts, canaries=canaries, wave_size=wave_size)
+    results = [HostResult(host, wave_number)
+               for wave_number, wave in enumerate(waves) for host in wave]
+    report = FleetReport(results)
+    finished = []
+
+    def halt_reason(result):
+        if result.status != 'failed':
+            return None
+        if canaries > 0 and result.wave == 0:
+            return 'canary %s failed' % result.host
+        failed = sum(1 for r in finished if r.status == 'failed')
+        if float(failed) / len(results) > max_failure_rate:
+            return ('%d of %d hosts failed, over the limit of %g%%'
+                    % (failed, len(results), max_failure_rate * 100))
+        return None
+
+    def finish(result):
+        finished.append(result)
+        logging.info('%s %s after %.1fs'
+                     % (result.host, result.status, result.duration))
+        events.emit('host-finished', host=result.host,
+                    status=result.status, duration=result.duration)
+        if report.halted is None:
+            report.halted = halt_reason(result)
+            if report.halted is not None:
+                logging.error('Halting roll-out: %s' % report.halted)
+                events.emit('halted', reason=report.halted)
+
+    pending = collections.deque()
+    running = {}
+    for wave_number, wave in enumerate(waves):
+        pending.extend(result for result in results
+                       if result.wave == wave_number)
+        while pending or running:
+            while pending and len(set(running.itervalues())) < parallel \
+                  and report.halted is None:
+                result = pending.popleft()
+                result.started = time.time()
+                result.status = 'running'
+                logging.info('Starting %s in wave %d'
+                             % (result.host, result.wave))
+                try:
+                    process = transport.start(result.host, list(argv))
+                except OSError as e:
+                    result.status = 'failed'
+                    result.stderr.append(str(e))
+                    result.duration = 0.0
+                    finish(result)
+                    continue
+                events.emit('host-started', host=result.host,
+                            wave=result.wave)
+                run = _Running(result, process)
+                for fd in run.fds():
+                    running[fd] = run
+            if report.halted is not None and pending:
+                for result in pending:
+                    result.status = 'not-started'
+                pending.clear()
+            if not running:
+                continue
+
+            try:
+                readable, _, _ = select.select(running.keys(), [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                run = running[fd]
+                if run.read(fd):
+                    continue
+                del running[fd]
+                if run.fds():
+                    continue
+                result = run.result
+                result.returncode = run.process.wait()
+                result.duration = time.time() - result.started
+                result.status = ('succeeded' if result.returncode == 0
+                                 else 'failed')
+                run.process.stdout.close()
+                run.process.stderr.close()
+                finish(result)
+        if report.halted is not None:
+            break
+    return report
+
+
+def run():
+    import argparse
+    import shlex
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    ap = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=
+                                     argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', dest='hosts', action='append', default=[],
+                    help='Host to migrate, may be given more than once')
+    ap.add_argument('--hosts-file', type=argparse.FileType('r'),
+                    help='File listing hosts to migrate, one per line')
+    ap.add_argument('--transport', choices=('ssh', 'local'), default='ssh',
+                    help='How to run commands on hosts, local runs them '
+                         'all here')
+    ap.add_argument('--ssh-option', dest='ssh_options', action='append',
+                    default=[], help='Option to pass to ssh')
+    ap.add_argument('--command', default=None,
+                    help='Command to run on each host, which must write '
+                         'events to its stdout, default: %s'
+                         % ' '.join(default_command))
+    ap.add_argument('--canaries', type=int, default=1,
+                    help='Number of hosts to migrate first on their own')
+    ap.add_argument('--wave-size', type=int, default=None,
+                    help='Number of hosts in each later wave, default all')
+    ap.add_argument('--parallel', type=int, default=10,
+                    help='Most hosts to migrate at once')
+    ap.add_argument('--max-failure-rate', type=float, default=0.1,
+                    help='Stop starting hosts once more than this '
+                         'fraction of all hosts have failed')
+    ap.add_argument('--events-fd', type=int, default=None,
+                    help='Write roll-out events as JSON lines to this fd')
+    ap.add_argument('--json', action='store_true', default=False,
+                    help='Print the report as JSON')
+    ap.add_argument('args', nargs=argparse.REMAINDER,
+                    help='Arguments for the command, after --')
+    opts = ap.parse_args()
+
+    hosts = list(opts.hosts)
+    if opts.hosts_file is not None:
+        hosts.extend(line.strip() for line in opts.hosts_file
+                     if line.strip() and not line.startswith('#'))
+    if not hosts:
+        ap.error('No hosts given')
+    if opts.parallel < 1:
+        ap.error('--parallel must be at least 1')
+    argv = (shlex.split(opts.command) if opts.command is not None
+            else list(default_command))
+    args = opts.args
+    if args and args[0] == '--':
+        args = args[1:]
+    argv.extend(args)
+    if opts.transport == 'local':
+        transport = LocalTransport()
+    else:
+        transport = SSHTransport(ssh_options=opts.ssh_options)
+    events = EventStream(os.fdopen(opts.events_fd, 'w')
+                         if opts.events_fd is not None else None)
+
+    try:
+        report = roll_out(hosts, transport, argv=argv,
+                          canaries=opts.canaries, wave_size=opts.wave_size,
+                          parallel=opts.parallel,
+                          max_failure_rate=opts.max_failure_rate,
+                          events=events)
+    finally:
+        events.close()
+
+    summary = report.as_dict()
+    if opts.json:
+        json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        for status, status_hosts in sorted(summary['hosts'].iteritems()):
+            print('%s: %d %s' % (status, len(status_hosts),
+                                 ' '.join(status_hosts)))
+        print('pids: %s' % ', '.join('%d %s' % (count, outcome)
+                                     for outcome, count
+                                     in sorted(summary['pids'].iteritems())))
+        if summary['duration']['max'] is not None:
+            print('duration: median %.1fs, max %.1fs'
+                  % (summary['duration']['median'],
+                     summary['duration']['max']))
+        for result in report.results:
+            if result.status == 'failed':
+                print('%s failed:' % result.host)
+                for line in result.stderr:
+                    print('    %s' % line)
+        if report.halted is not None:
+            print('halted: %s' % report.halted)
+    if report.halted is not None or 'failed' in summary['hosts']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Run helper commands from a small process inside a mount namespace.
+
+Running canned commands directly forks the whole migrating process for
+every command. A fork server is a separate, small Python process started
+once per namespace, which enters the namespace and spawns commands for us,
+so each command only costs a posix_spawn.
+
+Requests and responses are pickled over the server's stdin and stdout. A
+request is an argv list, and the response is a (status, output, error)
+tuple, where output is what the command wrote to stdout, and error is an
+(errno, message) pair if it couldn't be started. Commands' stderr goes to
+the server's stderr.
+
+'''
+
+
+import contextlib
+import cPickle
+import fcntl
+import os
+import subprocess
+import sys
+
+from .canned_command_runner import can_command
+from .ll.nsenter import nsenter, CLONE_NEWNS
+from .ll.posix_spawn import posix_spawn
+
+
+__all__ = ('ForkServer', 'forkserver_commands')
+
+
+def _set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+class ForkServer(object):
+    '''Start a fork server in the mount namespace open as `namespace_fobj`.
+
+    The server inherits our fds that aren't close-on-exec, such as those of
+    canned binaries and our root, so they can be used by the commands it
+    runs.
+
+    '''
+    def __init__(self, namespace_fobj):
+        package_parent = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_parent] + [path for path in
+                                env.get('PYTHONPATH', '').split(os.pathsep)
+                                if path])
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'migratelib.forkserver',
+             str(namespace_fobj.fileno())],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=False,
+            env=env)
+
+    def run(self, argv):
+        '''Run `argv` in the server, returning its status and output.'''
+        cPickle.dump(list(argv), self.process.stdin, cPickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+        status, output, error = cPickle.load(self.process.stdout)
+        if error is not None:
+            raise OSError(error[0], error[1], argv[0])
+        return status, output
+
+    def check_call(self, argv):
+        status, output = self.run(argv)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, argv)
+        return status
+
+    def check_output(self, argv):
+        status, output = self.run(argv)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, argv, output=output)
+        return output
+
+    def close(self):
+        # The server exits when it reads the end of its requests
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextlib.contextmanager
+def forkserver_commands(namespace, root_fdno):
+    '''Yield mount_cmd, umount_cmd and findmnt_cmd run in `namespace`.
+
+    These are canned, as with canned_command_runner, but run by a fork
+    server in the namespace rather than forked from this process.
+
+    '''
+    mount_argv, mount_fobj = can_command('mount', root_fdno)
+    umount_argv, umount_fobj = can_command('umount', root_fdno)
+    findmnt_argv, findmnt_fobj = can_command('findmnt', root_fdno)
+    with mount_fobj, umount_fobj, findmnt_fobj, \
+         ForkServer(namespace.mount_ns_fobj) as server:
+        def mount_cmd(mountargs):
+            return server.check_call(mount_argv + mountargs.argv)
+        def umount_cmd(target, detach=False):
+            argv = list(umount_argv)
+            if detach:
+                argv.append('-l')
+            argv.append(target)
+            return server.check_call(argv)
+        def findmnt_cmd(argv):
+            return server.check_output(findmnt_argv + argv)
+        yield mount_cmd, umount_cmd, findmnt_cmd
+
+
+def _spawn(argv):
+    out_r, out_w = os.pipe()
+    _set_cloexec(out_r)
+    try:
+        pid = posix_spawn(argv[0], argv, os.environ,
+                          dup2s=((out_w, 1),),
+                          closes=(out_w,))
+    finally:
+        os.close(out_w)
+    chunks = []
+    try:
+        while True:
+            chunk = os.read(out_r, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(out_r)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status), ''.join(chunks)
+    return os.WEXITSTATUS(status), ''.join(chunks)
+
+
+def serve(namespace_fd):
+    # Keep the request and response pipes away from fds 0 and 1, so
+    # commands can't read our requests and stray output can't corrupt
+    # our responses
+    requests = os.fdopen(os.dup(0), 'rb')
+    responses = os.fdopen(os.dup(1), 'wb')
+    _set_cloexec(requests.fileno())
+    _set_cloexec(responses.fileno())
+    empty_r, empty_w = os.pipe()
+    os.close(empty_w)
+    os.dup2(empty_r, 0)
+    os.close(empty_r)
+    os.dup2(2, 1)
+
+    nsenter(namespace_fd, CLONE_NEWNS)
+    os.close(namespace_fd)
+
+    while True:
+        try:
+            argv = cPickle.load(requests)
+        except EOFError:
+            return
+        try:
+            status, output = _spawn(argv)
+            response = (status, output, None)
+        except OSError as e:
+            response = (None, None, (e.errno, e.strerror))
+        cPickle.dump(response, responses, cPickle.HIGHEST_PROTOCOL)
+        responses.flush()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]))
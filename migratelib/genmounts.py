@@ -17,12 +17,13 @@
 'Generate mount arguments from a list of existing mounts and replacement rules'
 
 
+import collections
 import logging
 import os
 import warnings
 
 
-__all__ = ('generate_mount_commands',)
+__all__ = ('generate_mount_commands', 'plan_mount_commands', 'OverlayMount')
 
 
 class Mount(object):
@@ -45,34 +46,259 @@ class BindMount(Mount):
         self.target = target
 
 
+class RecursiveBindMount(BindMount):
+    options = ('rbind',)
+
+
 class DiskMount(Mount):
     def __init__(self, source, target, type=None, options=()):
         self.source = source
         self.target = target
         self.type = type
         self.options = options
-        
+
+
+def _overlay_escape(path):
+    # overlayfs splits its options at commas and layer lists at colons
+    return (path.replace('\\', '\\\\').replace(',', '\\,')
+            .replace(':', '\\:'))
+
+
+class OverlayMount(Mount):
+    '''An overlayfs of `upper` on top of `lower`, mounted at `target`.
+
+    Only files changed in `upper` need to exist there, the rest are read
+    from `lower`, which is normally the mount being replaced. `work` must be
+    an empty directory on the same filesystem as `upper`.
+
+    '''
+    type = 'overlay'
+    source = 'overlay'
+    def __init__(self, lower, upper, work, target, options=()):
+        self.lower = lower
+        self.upper = upper
+        self.work = work
+        self.target = target
+        self.extra_options = tuple(options)
+
+    @property
+    def options(self):
+        return (('lowerdir=' + _overlay_escape(self.lower),
+                 'upperdir=' + _overlay_escape(self.upper),
+                 'workdir=' + _overlay_escape(self.work))
+                + self.extra_options)
+
+
+def _replacement_for(mount, replace):
+    matching_filters = [(matches, mnt_opts)
+                        for matches, mnt_opts in replace.iteritems()
+                        if all(filter_key in mount
+                               and mount[filter_key] == filter_value
+                               for filter_key, filter_value in matches)]
+    if len(matching_filters) > 1:
+        warnings.warn('Filters multiple filters match mount %s'
+                      % ' '.join('%s=%s' % pair for pair in mount.iteritems()))
+    if matching_filters:
+        matches, mnt_opts = matching_filters[0]
+        return mnt_opts
+    return None
+
+
+def _new_target(mount, new_root):
+    return os.path.join(new_root, mount['TARGET'].lstrip('/'))
+
+
+def _replacement_mount(mount, replacement, new_target):
+    mount_source, mount_type, mount_opts = replacement
+    upper = [opt for opt in mount_opts if opt.startswith('upperdir=')]
+    work = [opt for opt in mount_opts if opt.startswith('workdir=')]
+    lower = [opt for opt in mount_opts if opt.startswith('lowerdir=')]
+    if mount_type == 'overlay' and upper and work and not lower:
+        # An update layer, which goes on top of the mount it replaces
+        return OverlayMount(lower=mount['TARGET'],
+                            upper=upper[0][len('upperdir='):],
+                            work=work[0][len('workdir='):],
+                            target=new_target,
+                            options=[opt for opt in mount_opts
+                                     if opt not in upper + work])
+    return DiskMount(source=mount_source, target=new_target,
+                     type=mount_type, options=mount_opts)
+
 
 def generate_mount_commands(mount_list, replace, new_root):
     for mount in mount_list:
-        new_target = os.path.join(new_root, mount['TARGET'].lstrip('/'))
-        matching_filters = [(matches, mnt_opts)
-                            for matches, mnt_opts in replace.iteritems()
-                            if all(filter_key in mount
-                                   and mount[filter_key] == filter_value
-                                   for filter_key, filter_value in matches)]
-        if len(matching_filters) > 1:
-            warnings.warn('Filters multiple filters match mount %s'
-                          % ' '.join('%s=%s' % pair for pair in mount.iteritems()))
-        if matching_filters:
-            matches, (mount_source, mount_type, mount_opts) = matching_filters[0]
+        new_target = _new_target(mount, new_root)
+        replacement = _replacement_for(mount, replace)
+        if replacement is not None:
+            mnt_cmd = _replacement_mount(mount, replacement, new_target)
             logging.info('mounting {src} to {tgt} with options {opts}'
-                         .format(src=mount_source, tgt=new_target,
-                                  opts=mount_opts))
-            mnt_cmd = DiskMount(source=mount_source, target=new_target,
-                                type=mount_type, options=mount_opts)
+                         .format(src=mnt_cmd.source, tgt=new_target,
+                                  opts=mnt_cmd.options))
         else:
             logging.info('binding {src} to {tgt}'
                          .format(src=mount['TARGET'], tgt=new_target))
             mnt_cmd = BindMount(source=mount['TARGET'], target=new_target)
         yield mnt_cmd
+
+
+def _is_under(path, target):
+    return path == target or path.startswith(target.rstrip('/') + '/')
+
+
+def _subtree_ids(mount, children):
+    ids = set()
+    to_visit = [mount]
+    while to_visit:
+        mount = to_visit.pop()
+        ids.add(mount['ID'])
+        to_visit.extend(children[mount['ID']])
+    return ids
+
+
+def _check_plan(plan, mount_list, replace, new_root, keep_out):
+    children = collections.defaultdict(list)
+    for mount in mount_list:
+        children[mount['PARENT']].append(mount)
+    expanded = []
+    for mnt_cmd, mounts in plan:
+        if not isinstance(mnt_cmd, RecursiveBindMount):
+            expanded.append(mnt_cmd.argv)
+            continue
+        # A recursive bind copies everything mounted under its source, so
+        # that must be exactly the mounts it's listed as copying, and
+        # nothing left out of mount_list
+        if (mnt_cmd.source != mounts[0]['TARGET']
+            or _subtree_ids(mounts[0], children)
+               != set(mount['ID'] for mount in mounts)
+            or any(_is_under(path, mnt_cmd.source) for path in keep_out)):
+            return False
+        expanded.extend(BindMount(source=mount['TARGET'],
+                                  target=_new_target(mount, new_root)).argv
+                        for mount in mounts)
+    # Expanding every recursive bind into the binds of the mounts it copies
+    # must give exactly what generate_mount_commands would
+    expected = []
+    for mount in mount_list:
+        replacement = _replacement_for(mount, replace)
+        new_target = _new_target(mount, new_root)
+        if replacement is not None:
+            expected.append(_replacement_mount(mount, replacement,
+                                               new_target).argv)
+        else:
+            expected.append(BindMount(source=mount['TARGET'],
+                                      target=new_target).argv)
+    return expanded == expected
+
+
+def plan_mount_commands(mount_list, replace, new_root, exclude=()):
+    '''Like generate_mount_commands, but with as few mounts as possible.
+
+    Subtrees of `mount_list` without any replaced mounts are copied with one
+    recursive bind mount, so individual mounts are only made along the paths
+    to replaced mounts. `mount_list` must list parents before children, as
+    MountSnapshot.submounts does.
+
+    A recursive bind would also copy mounts that were left out of
+    `mount_list`, so the targets in `exclude` that were left out, and
+    `new_root` itself, are never under one.
+
+    The plan is checked against generate_mount_commands, which is used
+    instead if they would give different trees.
+
+    '''
+    mount_list = list(mount_list)
+    keep_out = list(exclude) + [new_root]
+    if any('PARENT' not in mount for mount in mount_list):
+        logging.warning('Mount parents unknown, creating every mount')
+        return list(generate_mount_commands(mount_list, replace, new_root))
+
+    # Children come after their parents, so in reverse every mount is seen
+    # after all of its children
+    dirty = {}
+    for mount in reversed(mount_list):
+        dirty[mount['ID']] = (dirty.get(mount['ID'], False)
+                              or _replacement_for(mount, replace) is not None
+                              or any(_is_under(path, mount['TARGET'])
+                                     for path in keep_out))
+        if dirty[mount['ID']]:
+            dirty[mount['PARENT']] = True
+
+    plan = []
+    copied_by = {} # mount ID -> mounts copied by its recursive bind
+    for mount in mount_list:
+        if mount['PARENT'] in copied_by:
+            copied = copied_by[mount['PARENT']]
+            copied.append(mount)
+            copied_by[mount['ID']] = copied
+        elif not dirty[mount['ID']]:
+            mnt_cmd = RecursiveBindMount(source=mount['TARGET'],
+                                         target=_new_target(mount, new_root))
+            copied_by[mount['ID']] = [mount]
+            plan.append((mnt_cmd, copied_by[mount['ID']]))
+        else:
+            mnt_cmd, = generate_mount_commands([mount], replace, new_root)
+            plan.append((mnt_cmd, [mount]))
+
+    if not _check_plan(plan, mount_list, replace, new_root, keep_out):
+        warnings.warn('Minimal mount plan differs from the full one, '
+                      'creating every mount')
+        return list(generate_mount_commands(mount_list, replace, new_root))
+    for mnt_cmd, mounts in plan:
+        if isinstance(mnt_cmd, RecursiveBindMount):
+            logging.info('recursively binding {src} to {tgt}, copying {n} '
+                         'mounts'.format(src=mnt_cmd.source,
+                                         tgt=mnt_cmd.target, n=len(mounts)))
+    return [mnt_cmd for mnt_cmd, mounts in plan]
+
+
+def test():
+    '''Mount an update layer over a tmpfs, which needs to be root, or run
+    with `unshare -Urm` on kernels that allow overlayfs in user namespaces.
+    '''
+    import shutil
+    import subprocess
+    import tempfile
+
+    base = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['mount', '-t', 'tmpfs', 'tmpfs', base])
+        try:
+            # Commas and colons in paths must be escaped in the options
+            lower = os.path.join(base, 'lower,1')
+            upper = os.path.join(base, 'update:1/upper')
+            work = os.path.join(base, 'update:1/work')
+            target = os.path.join(base, 'new')
+            for path in (lower, upper, work, target):
+                os.makedirs(path)
+            for layer, name in ((lower, 'kept'), (lower, 'changed'),
+                                (upper, 'changed')):
+                with open(os.path.join(layer, name), 'w') as f:
+                    f.write(layer)
+
+            mount = {'TARGET': lower, 'ID': '1'}
+            replacement = ('overlay', 'overlay', ('upperdir=' + upper,
+                                                  'workdir=' + work))
+            mnt_cmd = _replacement_mount(mount, replacement, target)
+            assert isinstance(mnt_cmd, OverlayMount)
+            assert mnt_cmd.argv == [
+                '-t', 'overlay', '-o',
+                'lowerdir=%s,upperdir=%s,workdir=%s' % (
+                    lower.replace(',', '\\,'), upper.replace(':', '\\:'),
+                    work.replace(':', '\\:')),
+                'overlay', target]
+
+            subprocess.check_call(['mount'] + mnt_cmd.argv)
+            try:
+                for name, layer in (('kept', lower), ('changed', upper)):
+                    with open(os.path.join(target, name)) as f:
+                        assert f.read() == layer
+            finally:
+                subprocess.check_call(['umount', target])
+        finally:
+            subprocess.check_call(['umount', base])
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,198 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Record migration progress so an interrupted migration can be resumed.
+
+The journal is a file of JSON records, one per line, each written and synced
+to disk once the step it describes has completed. Records are keyed by the
+namespace inode and root being migrated, and each migration of a root goes
+through these steps:
+
+tree-mounted
+    The new mount tree has been constructed at "tree".
+pid-migrated
+    The process in "process" has been moved into the new tree.
+pivoted
+    The namespace has been pivoted into the new tree, and the old root is
+    at "put_old".
+pivot-reverted
+    Something failed after pivoting, so we pivoted back again.
+detached
+    The old root has been detached, or retained as a handle that doesn't
+    outlive the run.
+complete
+    Nothing more needs to be done.
+
+A migration can instead end with a rolled-back record, after which the root
+can be migrated again from the start.
+
+'''
+
+
+import json
+import logging
+import os
+
+from .migrate_process import revert_processes
+from .mount_tree import MountTree, remove_tree
+from .mount_commands import umount_cmd, findmnt_cmd
+from .ll.pivot_root import pivot_root
+
+
+__all__ = ('MigrationJournal', 'RootProgress', 'rollback_root')
+
+
+class RootProgress(object):
+    '''How far the migration of one root got.
+
+    If `journal` is None then progress is tracked but not recorded, so this
+    can be used in place of a journal when none is wanted.
+
+    '''
+    def __init__(self, journal=None, namespace=None, root=None):
+        self.journal = journal
+        self.namespace = namespace
+        self.root = root
+        self.tree = None
+        self.migrated = {}
+        self.put_old = None
+        self.pivoted = False
+        self.detached = False
+        self.complete = False
+
+    def apply(self, record):
+        step = record['step']
+        if step == 'tree-mounted':
+            self.tree = record['tree']
+        elif step == 'pid-migrated':
+            process = record['process']
+            self.migrated[process['pid']] = process
+        elif step == 'pivoted':
+            self.pivoted = True
+            self.put_old = record['put_old']
+        elif step == 'pivot-reverted':
+            self.pivoted = False
+            self.put_old = None
+        elif step == 'detached':
+            self.detached = True
+        elif step == 'complete':
+            self.complete = True
+        elif step == 'rolled-back':
+            self.__init__(self.journal, self.namespace, self.root)
+
+    def record(self, step, **fields):
+        record = dict(fields, step=step, namespace=self.namespace,
+                      root=self.root)
+        self.apply(record)
+        if self.journal is not None:
+            self.journal.write(record)
+
+    @property
+    def started(self):
+        return self.tree is not None and not self.complete
+
+    def is_migrated(self, pid, starttime):
+        process = self.migrated.get(pid)
+        # The pid may have been reused since it was migrated
+        return process is not None and process['starttime'] == starttime
+
+
+class MigrationJournal(object):
+    '''Durable log of migration steps, opened from `path`.
+
+    Existing records are read when the journal is opened, so the progress of
+    a previous run can be resumed.
+
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.progress = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A partially written record from a crash is the
+                        # last line, and its step didn't complete anyway
+                        logging.warning('Ignoring truncated journal record')
+                        continue
+                    self._progress(record['namespace'],
+                                   record['root']).apply(record)
+        self.fobj = open(path, 'a+')
+        self.fobj.seek(0, os.SEEK_END)
+        if self.fobj.tell() > 0:
+            self.fobj.seek(-1, os.SEEK_END)
+            if self.fobj.read(1) != '\n':
+                # Terminate the truncated record so ours start on a new line
+                self.fobj.write('\n')
+
+    def close(self):
+        self.fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _progress(self, namespace, root):
+        key = (namespace, root)
+        if key not in self.progress:
+            self.progress[key] = RootProgress(journal=self,
+                                              namespace=namespace, root=root)
+        return self.progress[key]
+
+    def for_root(self, namespace, root):
+        '''Return the RootProgress of migrating `root` in `namespace`.
+
+        If the last migration of that root completed, a fresh one is
+        started.
+
+        '''
+        progress = self._progress(namespace, root)
+        if progress.complete:
+            progress.__init__(self, namespace, root)
+        return progress
+
+    def write(self, record):
+        self.fobj.write(json.dumps(record) + '\n')
+        self.fobj.flush()
+        os.fsync(self.fobj.fileno())
+
+
+def rollback_root(progress, umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd):
+    '''Undo an incomplete migration described by `progress`.
+
+    This must be run inside the namespace the migration was in.
+
+    '''
+    if not progress.started:
+        logging.info('Nothing to roll back for %s' % progress.root)
+        return
+    if progress.detached:
+        raise Exception('Old root of %s has been detached, '
+                        'cannot roll back' % progress.root)
+    if progress.pivoted:
+        put_old = progress.put_old
+        # The tree we pivoted into is now our root, so it goes back where
+        # it was, relative to the old root
+        pivot_root(new_root=put_old,
+                   put_old=os.path.join(put_old, progress.tree.lstrip('/')))
+    revert_processes(progress.migrated.itervalues())
+    remove_tree(MountTree(root=progress.tree, mount_cmd=None,
+                          umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd))
+    progress.record('rolled-back')
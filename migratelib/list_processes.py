@@ -21,40 +21,321 @@
 import argparse
 import collections
 import ctypes
+import errno
+import logging
 import os
 import tempfile
 
-from .namespace import MountNamespace
+from .namespace import NamespacePool
+from .profiling import phase, add_profile_argument, profiled
 
 
-__all__ = ('collect_process_info',)
+__all__ = ('collect_process_info', 'ProcessIndex', 'select_pids',
+           'pids_in_cgroup', 'pids_in_namespaces', 'pids_running',
+           'unselected_pids', 'check_selection', 'PartialSelection',
+           'add_scope_arguments')
 
 
 def create_arg_parser():
     ap = argparse.ArgumentParser(description=__doc__)
+    add_scope_arguments(ap)
+    add_profile_argument(ap)
     return ap
 
 
-def collect_process_info():
-    #procinfo[ns][root] = set(pid)
-    procinfo = collections.defaultdict(lambda: collections.defaultdict(set))
+def add_scope_arguments(ap):
+    '''Add options to restrict which processes are selected to `ap`.'''
+    ap.add_argument('--cgroup', action='append', default=[],
+                    help='Only select processes in this cgroup v2 path, '
+                         'or its descendants')
+    ap.add_argument('--mount-ns', action='append', default=[], type=int,
+                    metavar='INODE',
+                    help='Only select processes in the mount namespace '
+                         'with this inode number')
+    ap.add_argument('--exe', action='append', default=[],
+                    help='Only select processes running this executable')
+
+
+def _all_pids():
     for pid_dir in os.listdir('/proc'):
         try:
-            pid = int(pid_dir, base=10)
+            yield int(pid_dir, base=10)
         except ValueError as e:
             continue
-        mountns = MountNamespace.from_pid(pid)
-        root = os.readlink(os.path.join('/proc', pid_dir, 'root'))
-        procinfo[mountns][root].add(pid)
+
+
+def _read_ids(path):
+    with open(path) as f:
+        return [int(line) for line in f]
+
+
+def _tgid(tid):
+    with open(os.path.join('/proc', str(tid), 'status')) as f:
+        for line in f:
+            if line.startswith('Tgid:'):
+                return int(line.split()[1])
+
+
+def pids_in_cgroup(path, cgroup_root='/sys/fs/cgroup'):
+    '''Yield the pids in the cgroup v2 `path` and all its descendants.'''
+    top = os.path.join(cgroup_root, path.lstrip('/'))
+    if not os.path.isdir(top):
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), top)
+    for dirpath, dirnames, filenames in os.walk(top):
+        try:
+            for pid in _read_ids(os.path.join(dirpath, 'cgroup.procs')):
+                yield pid
+        except IOError as e:
+            # Threaded cgroups only list threads
+            if e.errno != errno.EOPNOTSUPP:
+                raise
+            for tid in _read_ids(os.path.join(dirpath, 'cgroup.threads')):
+                try:
+                    yield _tgid(tid)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+
+def _mount_ns_of(pid):
+    try:
+        return os.stat('/proc/%d/ns/mnt' % pid).st_ino
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.EACCES):
+            raise
+        return None
+
+
+def _exe_of(pid):
+    try:
+        return os.readlink('/proc/%d/exe' % pid)
+    except OSError as e:
+        # Kernel threads have no executable
+        if e.errno not in (errno.ENOENT, errno.EACCES):
+            raise
+        return None
+
+
+def pids_in_namespaces(inodes):
+    '''Yield the pids in any of the mount namespaces in `inodes`.'''
+    inodes = frozenset(inodes)
+    for pid in _all_pids():
+        if _mount_ns_of(pid) in inodes:
+            yield pid
+
+
+def pids_running(executables):
+    '''Yield the pids running any of the paths in `executables`.'''
+    executables = frozenset(os.path.realpath(exe) for exe in executables)
+    for pid in _all_pids():
+        if _exe_of(pid) in executables:
+            yield pid
+
+
+def select_pids(cgroups=(), namespaces=(), executables=()):
+    '''Return the set of pids matching all the kinds of selector given.
+
+    A pid matches a kind of selector if it matches any of the values given
+    for that kind. If no selectors are given, then None is returned, meaning
+    every process.
+
+    '''
+    if not (cgroups or namespaces or executables):
+        return None
+    if cgroups:
+        candidates = set()
+        for cgroup in cgroups:
+            candidates.update(pids_in_cgroup(cgroup))
+    else:
+        candidates = _all_pids()
+    inodes = frozenset(namespaces)
+    executables = frozenset(os.path.realpath(exe) for exe in executables)
+    # One pass over the candidates, rather than a scan of /proc per kind
+    selected = set()
+    for pid in candidates:
+        if inodes and _mount_ns_of(pid) not in inodes:
+            continue
+        if executables and _exe_of(pid) not in executables:
+            continue
+        selected.add(pid)
+    return selected
+
+
+def unselected_pids(namespace, pids_in_root):
+    '''Return the pids in `namespace` inside the roots of `pids_in_root`,
+    or roots nested in them, that aren't among their pids.
+
+    Kernel threads and this process are left out, as they aren't migrated.
+
+    '''
+    selected = set().union(*pids_in_root.itervalues())
+    unselected = set()
+    for pid in pids_in_namespaces([namespace.inode]):
+        if pid in selected or pid == os.getpid() or _exe_of(pid) is None:
+            continue
+        try:
+            root = os.readlink('/proc/%d/root' % pid)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+                raise
+            continue
+        if any(root == outer or root.startswith(outer.rstrip('/') + '/')
+               for outer in pids_in_root):
+            unselected.add(pid)
+    return unselected
+
+
+class PartialSelection(Exception):
+    '''Only some of the processes in the roots to migrate were selected.'''
+    def __init__(self, pids):
+        self.pids = sorted(pids)
+        Exception.__init__(self, 'Pids %s are in the selected roots but not '
+                                 'selected, and would be left using the old '
+                                 'root' % ', '.join(map(str, self.pids)))
+
+
+def check_selection(namespace, pids_in_root, force=False):
+    '''Raise PartialSelection if `pids_in_root` leaves out processes in
+    its roots, or just warn if `force`.
+
+    Pivoting changes the root of every process in the namespace, but only
+    selected ones have their working directory and open directories moved.
+
+    '''
+    unselected = unselected_pids(namespace, pids_in_root)
+    if not unselected:
+        return
+    error = PartialSelection(unselected)
+    if not force:
+        raise error
+    logging.warning('%s' % error)
+
+
+def select_pids_from_opts(opts):
+    '''Select pids with the options added by add_scope_arguments.'''
+    return select_pids(cgroups=opts.cgroup, namespaces=opts.mount_ns,
+                       executables=opts.exe)
+
+
+def collect_process_info(pool=None, pids=None):
+    '''Map each namespace and root to the pids in it.
+
+    Namespaces are taken from `pool` if given, or a new NamespacePool, so
+    each namespace is only opened once. If `pids` is given, only those pids
+    are looked at, rather than every process.
+
+    '''
+    if pool is None:
+        pool = NamespacePool()
+    if pids is None:
+        pids = _all_pids()
+    #procinfo[ns][root] = set(pid)
+    procinfo = collections.defaultdict(lambda: collections.defaultdict(set))
+    with phase('scan'):
+        for pid in pids:
+            try:
+                mountns = pool.get(pid)
+                root = os.readlink(os.path.join('/proc', str(pid), 'root'))
+            except (IOError, OSError) as e:
+                # Selected processes may have exited since they were selected
+                if e.errno not in (errno.ENOENT, errno.ESRCH):
+                    raise
+                continue
+            procinfo[mountns][root].add(pid)
     return procinfo
 
 
+class ProcessIndex(object):
+    '''Index of which pids are in which namespace and root, kept up to date.
+
+    Unlike collect_process_info, this keeps one MountNamespace per distinct
+    namespace open between refreshes, so a long-running process only opens
+    namespace files for namespaces it hasn't seen before.
+
+    '''
+    def __init__(self):
+        self.pool = NamespacePool()
+        self._sources = {} # inode -> pid the namespace was opened from
+        self.pids = {} # pid -> (inode, root)
+
+    @property
+    def namespaces(self):
+        return self.pool.namespaces
+
+    def refresh(self):
+        with phase('scan'):
+            pids = {}
+            for pid_dir in os.listdir('/proc'):
+                try:
+                    pid = int(pid_dir, base=10)
+                except ValueError as e:
+                    continue
+                proc_path = os.path.join('/proc', pid_dir)
+                try:
+                    root = os.readlink(os.path.join(proc_path, 'root'))
+                    inode = self.pool.get(pid).inode
+                    self._sources.setdefault(inode, pid)
+                except (IOError, OSError) as e:
+                    # Process exited while we were looking at it
+                    if e.errno in (errno.ENOENT, errno.ESRCH):
+                        continue
+                    if e.errno == errno.EACCES:
+                        logging.warning('Cannot inspect pid %d: %s'
+                                        % (pid, e.strerror))
+                        continue
+                    raise
+                pids[pid] = (inode, root)
+
+        for inode in set(self.namespaces):
+            live_pids = [pid for pid, (pid_inode, root) in pids.iteritems()
+                         if pid_inode == inode]
+            if not live_pids:
+                self.pool.discard(inode)
+                del self._sources[inode]
+            elif self._sources[inode] not in pids:
+                # The mountinfo file of an exited process can't be read,
+                # so re-open the namespace from a process that's still alive
+                self.pool.discard(inode)
+                del self._sources[inode]
+                for pid in live_pids:
+                    try:
+                        reopened = self.pool.get(pid).inode
+                    except (IOError, OSError) as e:
+                        if e.errno not in (errno.ENOENT, errno.ESRCH):
+                            raise
+                        continue
+                    # It may have changed namespace since the scan
+                    self._sources.setdefault(reopened, pid)
+                    if reopened == inode:
+                        break
+                else:
+                    # Every process in it exited since the scan
+                    logging.info('Namespace %d has no processes left' % inode)
+                    if inode in self.pool.namespaces:
+                        self.pool.discard(inode)
+                    for pid in live_pids:
+                        del pids[pid]
+        self.pids = pids
+
+    @property
+    def procinfo(self):
+        procinfo = collections.defaultdict(lambda: collections.defaultdict(set))
+        for pid, (inode, root) in self.pids.iteritems():
+            procinfo[self.namespaces[inode]][root].add(pid)
+        return procinfo
+
+    def namespace_of(self, pid):
+        inode, root = self.pids[pid]
+        return self.namespaces[inode]
+
+
 def run():
     import pprint
     ap = create_arg_parser()
     opts = ap.parse_args()
 
-    procinfo = collect_process_info()
+    with profiled(opts.profile):
+        procinfo = collect_process_info(pids=select_pids_from_opts(opts))
     pprint.pprint(dict(procinfo))
 
 
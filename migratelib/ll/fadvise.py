@@ -0,0 +1,41 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Low-level binding for the posix_fadvise call'''
+
+
+import ctypes
+import os
+
+
+__all__ = ('posix_fadvise', 'POSIX_FADV_WILLNEED')
+
+
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+libc.posix_fadvise64.argtypes = (ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64, ctypes.c_int)
+
+
+POSIX_FADV_WILLNEED = 3
+
+
+def posix_fadvise(fd, offset, length, advice):
+    # posix_fadvise returns the error rather than setting errno
+    err = libc.posix_fadvise64(fd, offset, length, advice)
+    if err != 0:
+        raise OSError(err, os.strerror(err), 'advising on file')
@@ -16,21 +16,35 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-'''Low-level binding for the setns syscall'''
+'''Low-level bindings for the setns and pidfd_open syscalls'''
 
 
 import ctypes
 import os
 
 
-__all__ = ('nsenter',)
+__all__ = ('nsenter', 'pidfd_open', 'CLONE_NEWNS')
 
 
 libc = ctypes.CDLL('libc.so.6', use_errno=True)
 
 
-def nsenter(fd):
-    ret = libc.setns(fd, 0)
+CLONE_NEWNS = 0x00020000
+
+# Syscalls added since 4.20 have the same number on every architecture
+SYS_pidfd_open = 434
+
+
+def nsenter(fd, nstype=0):
+    ret = libc.setns(fd, nstype)
     if ret < 0:
         err = ctypes.get_errno()
         raise OSError(err, os.strerror(err), 'entering new namespace')
+
+
+def pidfd_open(pid):
+    ret = libc.syscall(SYS_pidfd_open, pid, 0)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), 'opening pidfd of %d' % pid)
+    return ret
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Low-level bindings for the open_tree and move_mount syscalls'''
+
+
+import ctypes
+import os
+
+
+__all__ = ('open_tree', 'move_mount', 'AT_FDCWD', 'AT_RECURSIVE',
+           'OPEN_TREE_CLONE', 'OPEN_TREE_CLOEXEC', 'MOVE_MOUNT_F_EMPTY_PATH')
+
+
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+
+# Syscalls added since 4.20 have the same number on every architecture
+SYS_open_tree = 428
+SYS_move_mount = 429
+
+AT_FDCWD = -100
+AT_EMPTY_PATH = 0x1000
+AT_RECURSIVE = 0x8000
+OPEN_TREE_CLONE = 1
+OPEN_TREE_CLOEXEC = 02000000
+MOVE_MOUNT_F_EMPTY_PATH = 0x00000004
+
+
+def open_tree(path, flags, dirfd=AT_FDCWD):
+    ret = libc.syscall(SYS_open_tree, dirfd, path, flags)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    return ret
+
+
+def move_mount(from_fd, to_path, flags=MOVE_MOUNT_F_EMPTY_PATH,
+               from_path='', to_dirfd=AT_FDCWD):
+    ret = libc.syscall(SYS_move_mount, from_fd, from_path, to_dirfd, to_path,
+                       flags)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), to_path)
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Low-level bindings for passing fds over unix sockets with sendmsg'''
+
+
+import ctypes
+import os
+import socket
+import struct
+
+
+__all__ = ('send_fds', 'recv_fds', 'peer_credentials')
+
+
+libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+
+SOL_SOCKET = 1
+SCM_RIGHTS = 1
+SO_PEERCRED = 17
+MSG_CMSG_CLOEXEC = 0x40000000
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _cmsghdr(ctypes.Structure):
+    _fields_ = [('cmsg_len', ctypes.c_size_t),
+                ('cmsg_level', ctypes.c_int),
+                ('cmsg_type', ctypes.c_int)]
+
+
+def _align(length):
+    alignment = ctypes.sizeof(ctypes.c_size_t)
+    return (length + alignment - 1) & ~(alignment - 1)
+
+
+_header_length = _align(ctypes.sizeof(_cmsghdr))
+
+
+def send_fds(sockfd, data, fds):
+    '''Send `data` and the fds in `fds` over the unix socket `sockfd`.'''
+    data_buffer = ctypes.create_string_buffer(data, len(data))
+    iov = _iovec(ctypes.cast(data_buffer, ctypes.c_void_p), len(data))
+    fd_array = (ctypes.c_int * len(fds))(*fds)
+    control_length = _header_length + _align(ctypes.sizeof(fd_array))
+    control = ctypes.create_string_buffer(control_length)
+    cmsg = _cmsghdr.from_buffer(control)
+    cmsg.cmsg_len = _header_length + ctypes.sizeof(fd_array)
+    cmsg.cmsg_level = SOL_SOCKET
+    cmsg.cmsg_type = SCM_RIGHTS
+    ctypes.memmove(ctypes.addressof(control) + _header_length, fd_array,
+                   ctypes.sizeof(fd_array))
+    msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                  ctypes.cast(control, ctypes.c_void_p), control_length, 0)
+    ret = libc.sendmsg(sockfd, ctypes.byref(msg), 0)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), 'sending fds')
+    return ret
+
+
+def recv_fds(sockfd, bufsize, maxfds):
+    '''Receive up to `bufsize` bytes and `maxfds` fds from `sockfd`.
+
+    Returns the data and a list of the fds, which are close-on-exec.
+
+    '''
+    data_buffer = ctypes.create_string_buffer(bufsize)
+    iov = _iovec(ctypes.cast(data_buffer, ctypes.c_void_p), bufsize)
+    control_length = (_header_length
+                      + _align(maxfds * ctypes.sizeof(ctypes.c_int)))
+    control = ctypes.create_string_buffer(control_length)
+    msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                  ctypes.cast(control, ctypes.c_void_p), control_length, 0)
+    ret = libc.recvmsg(sockfd, ctypes.byref(msg), MSG_CMSG_CLOEXEC)
+    if ret < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), 'receiving fds')
+    fds = []
+    offset = 0
+    # Walk the control messages, though only SCM_RIGHTS is expected
+    while offset + _header_length <= msg.msg_controllen:
+        cmsg = _cmsghdr.from_buffer(control, offset)
+        if cmsg.cmsg_len < _header_length:
+            break
+        if cmsg.cmsg_level == SOL_SOCKET and cmsg.cmsg_type == SCM_RIGHTS:
+            count = ((cmsg.cmsg_len - _header_length)
+                     // ctypes.sizeof(ctypes.c_int))
+            fds.extend((ctypes.c_int * count).from_buffer(
+                control, offset + _header_length))
+        offset += _align(cmsg.cmsg_len)
+    return data_buffer.raw[:ret], fds
+
+
+def peer_credentials(sock):
+    '''Return the (pid, uid, gid) of the process at the other end of `sock`.
+    '''
+    ucred = sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', ucred)
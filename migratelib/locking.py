@@ -0,0 +1,384 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Lock roots of mount namespaces, so only unrelated migrations overlap.
+
+Every migration pivots the root of its whole mount namespace, so takes a
+lock on the namespace, named for its inode and locked with flock(2), for as
+long as it runs. Migrations of different namespaces run at once, and
+another of the same one waits or fails.
+
+Each root of each namespace has a lock file too, named for the namespace
+and a hash of the root. Migrating or staging a root takes its lock
+exclusively, and shared locks on every directory above it, since a tree
+replicated from / would copy the temporary mounts of staging /srv/chroot.
+So staging trees for disjoint chroots can run at once.
+
+Locks are released by the kernel when their holder exits, and whoever
+holds an exclusive lock records its pid, start time, host and command in
+the lock file. A lock that is still held after its holder exited was
+passed on to a child, and is reported with the pids still holding it.
+
+The lock files are opened outside of the namespaces being migrated, which
+may have their own /run, so must be made before entering them.
+
+'''
+
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+from .migrate_process import get_pid_starttime
+
+
+__all__ = ('MigrationLocks', 'MigrationLock', 'LockBusy', 'holder_id',
+           'add_lock_arguments', 'locks_from_opts')
+
+
+default_lock_dir = '/run/migratelib/locks'
+
+O_CLOEXEC = 02000000
+
+# Longest to sleep between attempts to take a busy lock
+_max_poll_interval = 1.0
+
+
+def _command(pid):
+    with open('/proc/%d/cmdline' % pid) as f:
+        return f.read().rstrip('\0').replace('\0', ' ')
+
+
+def holder_id(**extra):
+    '''Return what identifies this process as a lock holder.'''
+    pid = os.getpid()
+    holder = {'pid': pid, 'starttime': get_pid_starttime(pid),
+              'host': socket.gethostname(), 'command': _command(pid),
+              'since': time.time()}
+    holder.update(extra)
+    return holder
+
+
+def _is_running(pid, starttime=None):
+    try:
+        return starttime is None or get_pid_starttime(pid) == starttime
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def _lock_key(fd):
+    # How /proc/locks and fdinfo identify the locked file
+    st = os.fstat(fd)
+    return '%02x:%02x:%d' % (os.major(st.st_dev), os.minor(st.st_dev),
+                             st.st_ino)
+
+
+def _lock_pids(key):
+    '''Return the pids that took flocks on the file `key` identifies.'''
+    pids = []
+    with open('/proc/locks') as f:
+        for line in f:
+            fields = line.split()
+            # Blocked waiters are listed after "->", we never block
+            if fields[1] == 'FLOCK' and fields[5] == key:
+                pids.append(int(fields[4]))
+    return pids
+
+
+def _fd_holders(key):
+    '''Return the pids with an fd holding an flock on the file `key`
+    identifies, which include any that inherited it.'''
+    pids = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        fdinfo_dir = '/proc/%s/fdinfo' % pid
+        try:
+            for fileno in os.listdir(fdinfo_dir):
+                with open(os.path.join(fdinfo_dir, fileno)) as f:
+                    for line in f:
+                        if (line.startswith('lock:') and ' FLOCK ' in line
+                            and line.split()[6] == key):
+                            pids.add(int(pid))
+        except (IOError, OSError) as e:
+            # Exited, or not ours to look at
+            if e.errno not in (errno.ENOENT, errno.EACCES):
+                raise
+    return sorted(pids)
+
+
+def _describe(holder):
+    if holder.get('pid') is None:
+        return 'a process that exited or is in another pid namespace'
+    description = 'pid %d' % holder['pid']
+    if 'host' in holder:
+        description += ' on %s' % holder['host']
+    if 'command' in holder:
+        description += ' (%s)' % holder['command']
+    if 'since' in holder:
+        description += ' since %s' % time.strftime(
+            '%H:%M:%S', time.localtime(holder['since']))
+    if holder.get('exited'):
+        description += ', which has exited'
+    return description
+
+
+class LockBusy(Exception):
+    '''A lock was held by someone else for longer than we'd wait.
+
+    `holders` describe who holds it, as returned by MigrationLock.holders.
+
+    '''
+    def __init__(self, description, holders):
+        self.holders = holders
+        Exception.__init__(self, '%s is locked by %s' % (
+            description, '; '.join(_describe(holder) for holder in holders)
+                         or 'an unknown process'))
+
+
+class MigrationLock(object):
+    '''An flock(2) on the lock file at `path`, for what `description` says.
+
+    The file is opened when this is made, so it can be locked after
+    entering a namespace with a different filesystem. It's waited for for
+    up to `timeout` seconds unless acquire is given another.
+
+    '''
+    def __init__(self, path, description, shared=False, timeout=None):
+        self.path = path
+        self.description = description
+        self.shared = shared
+        self.timeout = timeout
+        self.locked = False
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | O_CLOEXEC, 0600)
+
+    def _read_record(self):
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        data = os.read(self.fd, 65536)
+        try:
+            return json.loads(data) if data else None
+        except ValueError:
+            # Being written
+            return None
+
+    def holders(self):
+        '''Describe the processes holding this lock.
+
+        Each is a dict with the "pid" that took it, or None if that isn't
+        visible, whether it has "exited", and what the lock file records
+        about it, or its "starttime" and "command" if it's running.
+
+        '''
+        record = self._read_record()
+        holders = []
+        for pid in _lock_pids(_lock_key(self.fd)):
+            # A holder that exited and whose pid was freed is shown as 0
+            if record is not None and pid in (record.get('pid'), 0):
+                holder = dict(record)
+            elif pid == 0:
+                holder = {'pid': None}
+            else:
+                holder = {'pid': pid}
+                try:
+                    holder['starttime'] = get_pid_starttime(pid)
+                    holder['command'] = _command(pid)
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            holder['exited'] = (holder['pid'] is None or not _is_running(
+                holder['pid'], holder.get('starttime')))
+            holders.append(holder)
+        return holders
+
+    def _warn_if_stale(self, holders):
+        if not holders or not all(holder['exited'] for holder in holders):
+            return
+        pids = _fd_holders(_lock_key(self.fd))
+        logging.warning('%s was locked by %s, and is still held by pids %s, '
+                        'which inherited its lock'
+                        % (self.description,
+                           '; '.join(_describe(holder) for holder in holders),
+                           ', '.join(str(pid) for pid in pids) or 'unknown'))
+
+    def acquire(self, timeout=None, **record):
+        '''Take the lock, waiting for up to `timeout` seconds.
+
+        A `timeout` of None uses the lock's own, and if that's None too,
+        waits as long as it takes, while 0 fails at once if it's held,
+        raising LockBusy. Keyword arguments are added to the holder record
+        of an exclusive lock.
+
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        interval = 0.05
+        waiting = False
+        operation = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        while True:
+            try:
+                fcntl.flock(self.fd, operation | fcntl.LOCK_NB)
+                break
+            except IOError as e:
+                if e.errno != errno.EWOULDBLOCK:
+                    raise
+            holders = self.holders()
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                raise LockBusy(self.description, holders)
+            if not waiting:
+                logging.info('Waiting for %s, locked by %s'
+                             % (self.description, '; '.join(
+                                 _describe(holder) for holder in holders)))
+                self._warn_if_stale(holders)
+                waiting = True
+            time.sleep(interval if deadline is None
+                       else min(interval, deadline - now))
+            interval = min(interval * 2, _max_poll_interval)
+        self.locked = True
+        if not self.shared:
+            os.ftruncate(self.fd, 0)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, json.dumps(holder_id(**record)) + '\n')
+
+    def release(self):
+        if not self.locked:
+            return
+        if not self.shared:
+            os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.locked = False
+
+    def close(self):
+        self.release()
+        os.close(self.fd)
+
+
+def _ancestors(root):
+    '''List the directories above `root`, outermost first.'''
+    ancestors = []
+    while root != '/':
+        root = os.path.dirname(root)
+        ancestors.insert(0, root)
+    return ancestors
+
+
+class MigrationLocks(object):
+    '''Make the locks for migrations, in `lock_dir`.
+
+    Locks are waited for for up to `timeout` seconds, or as long as it
+    takes if that's None. If `lock_dir` is None then nothing is locked.
+
+    '''
+    def __init__(self, lock_dir=default_lock_dir, timeout=None):
+        self.lock_dir = lock_dir
+        self.timeout = timeout
+        if lock_dir is not None and not os.path.isdir(lock_dir):
+            os.makedirs(lock_dir)
+
+    def _lock(self, namespace_inode, name, description, shared=False,
+              timeout=None):
+        return MigrationLock(os.path.join(self.lock_dir,
+                                          '%d-%s.lock' % (namespace_inode,
+                                                          name)),
+                             description, shared=shared, timeout=timeout)
+
+    def _root_lock(self, namespace_inode, path, shared):
+        return self._lock(namespace_inode, hashlib.sha1(path).hexdigest()[:16],
+                          'Root %s of namespace %d' % (path, namespace_inode),
+                          shared=shared)
+
+    @contextlib.contextmanager
+    def roots(self, namespace_inode, roots):
+        '''Context with `roots` of a namespace locked for migrating.
+
+        The roots shouldn't be inside each other, so group_nested_roots
+        them first.
+
+        '''
+        if self.lock_dir is None:
+            yield
+            return
+        shared = {}
+        for root in roots:
+            root = os.path.normpath(root)
+            for ancestor in _ancestors(root):
+                shared.setdefault(ancestor, True)
+            shared[root] = False
+        deadline = None if self.timeout is None \
+                   else time.time() + self.timeout
+        held = []
+        try:
+            # Always locking in the same order means nobody can hold a lock
+            # that someone holding one they want is waiting for
+            for path in sorted(shared, key=lambda path: (path.count('/')
+                                                         if path != '/'
+                                                         else 0, path)):
+                lock = self._root_lock(namespace_inode, path, shared[path])
+                held.append(lock)
+                lock.acquire(timeout=None if deadline is None
+                                     else max(deadline - time.time(), 0),
+                             namespace=namespace_inode, root=path)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.close()
+
+    @contextlib.contextmanager
+    def namespace(self, namespace_inode):
+        '''Context with a namespace locked for a migration, which pivots it.
+
+        Take this before the locks on its roots.
+
+        '''
+        if self.lock_dir is None:
+            yield
+            return
+        lock = self._lock(namespace_inode, 'namespace',
+                          'Namespace %d' % namespace_inode,
+                          timeout=self.timeout)
+        try:
+            lock.acquire(namespace=namespace_inode)
+            yield
+        finally:
+            lock.close()
+
+
+def add_lock_arguments(ap):
+    '''Add the options read by locks_from_opts to `ap`.'''
+    ap.add_argument('--lock-dir', default=default_lock_dir,
+                    help='Directory of lock files, which must be shared '
+                         'with every other migration on the host')
+    ap.add_argument('--lock-wait', type=float, default=None,
+                    metavar='SECONDS',
+                    help='Fail if another migration of the same roots '
+                         'holds the locks for longer than this, by default '
+                         'waiting as long as it takes, 0 fails at once')
+    ap.add_argument('--no-lock', action='store_true', default=False,
+                    help='Migrate without locking')
+
+
+def locks_from_opts(opts):
+    return MigrationLocks(lock_dir=None if opts.no_lock else opts.lock_dir,
+                          timeout=opts.lock_wait)
@@ -22,70 +22,312 @@
 import logging
 import os
 
-from .findmnt import find_mounts, search_fields
+from .findmnt import MountSnapshot
+from .events import EventStream
+from .journal import rollback_root
+from .locking import MigrationLocks
+from .migrate_process import CapabilityCache
 from .migrate_root import migrate_root
 from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
 
 
-__all__ = ('migrate_namespace',)
+__all__ = ('migrate_namespace', 'namespace_snapshot', 'find_root_mounts',
+           'group_nested_roots', 'rollback_namespace')
+
+
+def namespace_snapshot(namespace, findmnt_cmd=findmnt_cmd):
+    '''Return a MountSnapshot of `namespace`'s mount table.
+
+    This must be called from inside `namespace`.
+
+    '''
+    # Our own view, since the process the namespace was opened from may be
+    # chrooted, and hide the mounts outside of its root. Not /proc/self, so
+    # findmnt_cmd can be run by another process.
+    return MountSnapshot(tab_file='/proc/%d/mountinfo' % os.getpid(),
+                         runcmd=findmnt_cmd)
+
+
+def find_root_mounts(snapshot, root, exclude=()):
+    '''List the mounts under `root` that need replicating.
+
+    Mounts at or under the targets in `exclude` are left out.
+
+    '''
+    # Can't pivot if we have non-private mount propagation
+    root_mount = snapshot.mount_at(root)
+    if root_mount is None or root_mount['PROPAGATION'] != 'private':
+        raise Exception("Cannot migrate namespace, %s mount "
+                        "propagation is not private, use "
+                        "`mount --make-rprivate /` to fix." % root)
+    return snapshot.submounts(root, exclude=exclude)
+
+
+def group_nested_roots(pids_in_root):
+    '''Merge the pids of roots nested inside other roots into the outermost.
+
+    A chroot under another root is copied along with it, so its processes
+    can move into the outer root's new tree instead of needing their own.
+
+    '''
+    grouped = {}
+    # Shorter paths first, so outer roots are seen before roots inside them
+    for root in sorted(pids_in_root, key=len):
+        for outer in grouped:
+            if root == outer or root.startswith(outer.rstrip('/') + '/'):
+                logging.debug('Migrating %s along with %s' % (root, outer))
+                grouped[outer] |= set(pids_in_root[root])
+                break
+        else:
+            grouped[root] = set(pids_in_root[root])
+    return grouped
 
 
 def migrate_namespace(namespace, pids_in_root, replacements,
                       mount_cmd=mount_cmd, umount_cmd=umount_cmd,
-                      findmnt_cmd=findmnt_cmd):
-    with namespace.entered():
+                      findmnt_cmd=findmnt_cmd, journal=None, retained=None,
+                      prewarm_budget=None, caps=None, events=None,
+                      exclude=(), strategy=None, locks=None, throttle=None):
+    '''Migrate every root in `pids_in_root` inside `namespace`.
+
+    If a MigrationJournal is passed as `journal`, then progress is recorded
+    in it, and any incomplete migration it records is resumed.
+
+    If a dict is passed as `retained`, then the old roots are retained
+    rather than destroyed, and a RetainedRoot for each is stored in it by
+    root.
+
+    `caps` is a CapabilityCache to share, otherwise one is made for the
+    whole namespace.
+
+    Progress is reported to `events`, if an EventStream is passed.
+
+    Mounts at or under the targets in `exclude` are not replicated, such as
+    staged trees that aren't being switched to.
+
+    Roots inside other roots, such as build chroots, are migrated with the
+    outermost, so only one new tree is made and pivoted into.
+
+    `strategy` is a TreeStrategy to choose how trees are built, otherwise
+    every mount is made with `mount_cmd`.
+
+    `locks` is a MigrationLocks to lock the namespace and the roots being
+    migrated with, which raises LockBusy if another migration holds them
+    for too long.
+
+    `throttle` is a Throttle to slow down with when the host is busy.
+
+    '''
+    if caps is None:
+        caps = CapabilityCache()
+    if events is None:
+        events = EventStream()
+    if locks is None:
+        locks = MigrationLocks(lock_dir=None)
+    grouped = group_nested_roots(pids_in_root)
+    # Lock files are outside the namespace, so are opened before entering
+    with locks.namespace(namespace.inode), \
+         locks.roots(namespace.inode, grouped), \
+         namespace.entered():
         if not os.path.isdir('/proc'):
             logging.info('Skipping %s' % namespace)
             return False
-        for root, pids in pids_in_root.iteritems():
-            # Can't pivot if we have non-private mount propagation
-            root_mount, = find_mounts(root=root, fields=('PROPAGATION',))
-            if root_mount['PROPAGATION'] != 'private':
-                raise Exception("Cannot migrate namespace, %s mount "
-                                "propagation is not private, use "
-                                "`mount --make-rprivate /` to fix." % root)
-            mount_list = find_mounts(root=root,
-                                     tab_file='/proc/self/fd/%d'
-                                         % namespace.mountinfo_fobj.fileno(),
-                                     fields=search_fields, recurse=True,
-                                     runcmd=findmnt_cmd)
-            migrate_root(root, pids, mount_list, replacements,
-                         mount_cmd=mount_cmd, umount_cmd=umount_cmd,
-                         findmnt_cmd=findmnt_cmd)
+        pid_count = sum(len(pids) for pids in pids_in_root.itervalues())
+        events.expect_pids(pid_count)
+        events.emit('namespace-entered', namespace=namespace.inode,
+                    pids=pid_count)
+        snapshot = namespace_snapshot(namespace, findmnt_cmd=findmnt_cmd)
+        for root, pids in grouped.iteritems():
+            progress = None
+            if journal is not None:
+                progress = journal.for_root(namespace.inode, root)
+            mount_list = None
+            if progress is None or not progress.started:
+                mount_list = find_root_mounts(snapshot, root, exclude=exclude)
+            retained_root = migrate_root(root, pids, mount_list, replacements,
+                                         mount_cmd=mount_cmd,
+                                         umount_cmd=umount_cmd,
+                                         findmnt_cmd=findmnt_cmd,
+                                         progress=progress,
+                                         snapshot=snapshot,
+                                         caps=caps, events=events,
+                                         retain=retained is not None,
+                                         prewarm_budget=prewarm_budget,
+                                         exclude=exclude, strategy=strategy,
+                                         throttle=throttle)
+            if retained_root is not None:
+                retained[root] = retained_root
         return True
 
 
+def rollback_namespace(namespace, journal, umount_cmd=umount_cmd,
+                       findmnt_cmd=findmnt_cmd, locks=None):
+    '''Roll back every incomplete migration `journal` records in `namespace`.
+    '''
+    if locks is None:
+        locks = MigrationLocks(lock_dir=None)
+    roots = [root for inode, root in journal.progress
+             if inode == namespace.inode]
+    with locks.namespace(namespace.inode), \
+         locks.roots(namespace.inode, roots), namespace.entered():
+        for (inode, root), progress in journal.progress.iteritems():
+            if inode == namespace.inode:
+                rollback_root(progress, umount_cmd=umount_cmd,
+                              findmnt_cmd=findmnt_cmd)
+
+
 def run():
     import argparse
+    import contextlib
     import logging
     import os
+    import socket
     import sys
     from .namespace import MountNamespace
     from . import replaceparser
-    from .list_processes import collect_process_info
+    from .journal import MigrationJournal
+    from .locking import add_lock_arguments, locks_from_opts
+    from .pressure import add_throttle_arguments, throttle_from_opts
+    from .staging import list_staged
+    from .forkserver import forkserver_commands
+    from .strategy import (TreeStrategy, construction_methods,
+                           default_history_path)
+    from .migrate_process import _gdb_runner
+    from .profiling import profiled, waiting, add_profile_argument
+    from .list_processes import (collect_process_info, add_scope_arguments,
+                                 select_pids_from_opts, check_selection)
     from .canned_command_runner import (root_fd, canned_mount_cmd,
                                         canned_umount_cmd, canned_findmnt_cmd)
 
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
     ap = argparse.ArgumentParser(description=__doc__)
     ap.add_argument('--namespace', default='/proc/self/ns/mnt')
+    ap.add_argument('--journal', default=None,
+                    help='Record progress in, and resume from, this file')
+    ap.add_argument('--rollback', action='store_true', default=False,
+                    help='Undo the incomplete migration in the journal')
+    ap.add_argument('--prewarm-budget', type=int, default=None,
+                    metavar='BYTES',
+                    help='Read up to this much of the new root into the '
+                         'page cache before migrating processes')
+    add_scope_arguments(ap)
+    ap.add_argument('--force', action='store_true', default=False,
+                    help='Migrate even if --cgroup or --exe leave out some '
+                         'processes in the selected roots, whose working '
+                         'directories and open directories stay in the old '
+                         'root after pivoting')
+    ap.add_argument('--events-fd', type=int, default=None,
+                    help='Write progress events as JSON lines to this fd')
+    ap.add_argument('--events-socket', default=None,
+                    help='Write progress events as JSON lines to this '
+                         'unix socket')
+    ap.add_argument('--forkserver', action='store_true', default=False,
+                    help='Run mount commands from a small process in the '
+                         'namespace, rather than forking this one')
+    ap.add_argument('--tree-method', choices=('auto',) + construction_methods,
+                    default='auto',
+                    help='How to make bind mounts, by default chosen from '
+                         'what works and earlier timings')
+    ap.add_argument('--strategy-history', default=default_history_path,
+                    help='File of earlier timings to choose methods by')
+    add_lock_arguments(ap)
+    add_throttle_arguments(ap)
+    add_profile_argument(ap)
     replaceparser.extend_arg_parser(ap)
     opts = ap.parse_args()
-    print opts
+    logging.debug('Options: %s' % opts)
+    if opts.rollback and opts.journal is None:
+        ap.error('--rollback requires --journal')
 
-    with open(opts.namespace) as mount_ns_fobj, \
+    events_fobj = None
+    if opts.events_fd is not None:
+        events_fobj = os.fdopen(opts.events_fd, 'w')
+    elif opts.events_socket is not None:
+        events_fobj = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        events_fobj.connect(opts.events_socket)
+    events = EventStream(events_fobj)
+    throttle = throttle_from_opts(opts, events=events)
+
+    @contextlib.contextmanager
+    def no_journal():
+        yield None
+
+    @contextlib.contextmanager
+    def canned_commands(namespace, root_fdno):
+        with canned_mount_cmd(root_fdno) as mount_cmd, \
+             canned_umount_cmd(root_fdno) as umount_cmd, \
+             canned_findmnt_cmd(root_fdno) as findmnt_cmd:
+            yield mount_cmd, umount_cmd, findmnt_cmd
+    if opts.forkserver:
+        canned_commands = forkserver_commands
+    strategy = TreeStrategy(history_path=opts.strategy_history,
+                            methods=(construction_methods
+                                     if opts.tree_method == 'auto'
+                                     else (opts.tree_method,)))
+    locks = locks_from_opts(opts)
+    if opts.journal is not None:
+        journal_cm = MigrationJournal(opts.journal)
+    else:
+        journal_cm = no_journal()
+
+    with profiled(opts.profile), \
+         open(opts.namespace) as mount_ns_fobj, \
          open(os.path.normpath(os.path.join(opts.namespace, '../../mountinfo'))) \
              as mountinfo_fobj:
         ns = MountNamespace(mount_ns_fobj, mountinfo_fobj)
-        procinfo = collect_process_info()
+        selected = select_pids_from_opts(opts)
+        procinfo = collect_process_info(pids=selected)
+        if selected is not None and not opts.rollback:
+            check_selection(ns, procinfo[ns], force=opts.force)
+        events.emit('scan-complete', namespaces=len(procinfo),
+                    pids=sum(len(pids) for roots in procinfo.itervalues()
+                             for pids in roots.itervalues()))
 
         with root_fd() as root_fdno, \
-             canned_mount_cmd(root_fdno) as mount_cmd, \
-             canned_umount_cmd(root_fdno) as umount_cmd, \
-             canned_findmnt_cmd(root_fdno) as findmnt_cmd:
-            migrate_namespace(namespace=ns, pids_in_root=procinfo[ns],
-                              replacements=opts.replace, mount_cmd=mount_cmd,
-                              umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd)
+             canned_commands(ns, root_fdno) as (mount_cmd, umount_cmd,
+                                                findmnt_cmd), \
+             journal_cm as journal:
+            # Count waiting for commands separately when profiling
+            mount_cmd = waiting('subprocess', mount_cmd)
+            umount_cmd = waiting('subprocess', umount_cmd)
+            findmnt_cmd = waiting('subprocess', findmnt_cmd)
+            caps = CapabilityCache(runcmd=waiting('ptrace', _gdb_runner))
+            if opts.rollback:
+                rollback_namespace(namespace=ns, journal=journal,
+                                   umount_cmd=umount_cmd,
+                                   findmnt_cmd=findmnt_cmd, locks=locks)
+                return
+            error = None
+            try:
+                migrate_namespace(namespace=ns, pids_in_root=procinfo[ns],
+                                  replacements=opts.replace,
+                                  mount_cmd=mount_cmd, umount_cmd=umount_cmd,
+                                  findmnt_cmd=findmnt_cmd, journal=journal,
+                                  prewarm_budget=opts.prewarm_budget,
+                                  caps=caps, events=events,
+                                  exclude=[staged['tree'] for staged
+                                           in list_staged(namespace=ns)],
+                                  strategy=strategy, locks=locks,
+                                  throttle=throttle)
+            except BaseException as e:
+                error = '%s: %s' % (type(e).__name__, e)
+                raise
+            finally:
+                # So readers can tell a failed migration from a finished one
+                outcome = {'ok': error is None}
+                if error is not None:
+                    outcome['error'] = error
+                if throttle is not None:
+                    summary = throttle.summary()
+                    logging.info('Throttling: %s' % summary)
+                    outcome['throttle'] = summary
+                events.close(**outcome)
+                # Back outside the namespace, which may have its own /run
+                try:
+                    strategy.save()
+                except (IOError, OSError) as e:
+                    logging.warning('Could not save strategy history to '
+                                    '%s: %s' % (strategy.history_path, e))
 
 
 if __name__ == '__main__':
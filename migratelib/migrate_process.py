@@ -29,9 +29,13 @@ import subprocess
 import sys
 import warnings
 
+from .profiling import phase, waiting, profiled, add_profile_argument
+
 
 __all__ = ('get_pid_cwd', 'get_pid_root', 'git_pid_dir_fds',
-           'run_gdb_cmd_in_pid', 'migrate_process')
+           'get_pid_starttime', 'get_pid_binary_identity',
+           'CapabilityCache', 'run_gdb_cmd_in_pid', 'migrate_process',
+           'revert_process', 'revert_processes')
 
 
 # json.dumps is the closest thing to c string escapes
@@ -46,6 +50,7 @@ def create_arg_parser():
     ap.add_argument('--root')
     ap.add_argument('--debug', default=False, action='store_const',
                     const=True)
+    add_profile_argument(ap)
     return ap
 
 
@@ -64,6 +69,16 @@ def get_pid_dir_fds(pid):
         if os.path.isdir(fd_link):
             yield int(fileno), os.readlink(fd_link)
 
+
+def get_pid_starttime(pid):
+    '''Return the start time of `pid`, to tell it apart from a reused pid'''
+    with open(os.path.join('/proc', str(pid), 'stat')) as f:
+        stat = f.read()
+    # comm may contain spaces and parentheses, so split after the last one
+    fields = stat[stat.rindex(')') + 2:].split()
+    # starttime is field 22, fields start at 3
+    return int(fields[22 - 3])
+
 def _gdb_runner(args, **kwargs):
     return subprocess.check_output(['gdb'] + args, **kwargs)
 
@@ -79,6 +94,108 @@ def errno_is_readable(pid, runcmd=_gdb_runner):
     return 'Cannot find thread-local variables on this target' not in out
 
 
+CAP_SYS_PTRACE = 19
+
+# LSMs that may refuse ptrace regardless of capabilities and yama
+_ptrace_restricting_lsms = frozenset(('selinux', 'apparmor', 'smack',
+                                      'tomoyo'))
+
+
+def _read_first_line(path, default=None):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return default
+
+
+def _read_status(pid):
+    status = {}
+    with open(os.path.join('/proc', str(pid), 'status')) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    return status
+
+
+def get_pid_binary_identity(pid):
+    '''Identify the executable and libc of `pid` by device and inode.
+
+    A running executable can't be replaced in place, so this identifies the
+    binary and libc a process is using for as long as it runs.
+
+    '''
+    exe = os.stat(os.path.join('/proc', str(pid), 'exe'))
+    libc = None
+    with open(os.path.join('/proc', str(pid), 'maps')) as maps:
+        for line in maps:
+            # address perms offset dev inode path
+            fields = line.split(None, 5)
+            if len(fields) == 6 and re.search(r'/libc[-.]', fields[5]):
+                libc = (fields[3], int(fields[4]))
+                break
+    return (exe.st_dev, exe.st_ino), libc
+
+
+class CapabilityCache(object):
+    '''Decide how processes can be migrated, probing as little as possible.
+
+    Whether a process can be ptraced is decided from its status, our
+    capabilities and the yama ptrace scope where that's conclusive, and only
+    probed with gdb otherwise. Whether errno can be read depends only on
+    the executable and libc, so it is probed once per pair.
+
+    '''
+    def __init__(self, runcmd=_gdb_runner):
+        self.runcmd = runcmd
+        self.errno_readable = {}
+        self.ptrace_scope = int(_read_first_line(
+            '/proc/sys/kernel/yama/ptrace_scope', default='0'))
+        lsms = _read_first_line('/sys/kernel/security/lsm', default='')
+        self.restricting_lsms = (_ptrace_restricting_lsms
+                                 & frozenset(lsms.split(',')))
+        cap_eff = int(_read_status('self')['CapEff'], 16)
+        self.can_ptrace = bool(cap_eff & (1 << CAP_SYS_PTRACE))
+
+    def _ptrace_permitted(self, pid):
+        '''Return whether ptrace is permitted, or None if unsure.'''
+        if self.ptrace_scope >= 3:
+            return False
+        status = _read_status(pid)
+        if status.get('TracerPid', '0') != '0':
+            # Only one tracer at a time
+            return False
+        try:
+            os.readlink(os.path.join('/proc', str(pid), 'exe'))
+        except OSError as e:
+            # Kernel threads have no executable and can't be traced
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        if self.restricting_lsms:
+            return None
+        if self.can_ptrace:
+            return True
+        if self.ptrace_scope >= 2:
+            return False
+        return None
+
+    def is_ptraceable(self, pid):
+        permitted = self._ptrace_permitted(pid)
+        if permitted is None:
+            return is_ptraceable(pid=pid, runcmd=self.runcmd)
+        return permitted
+
+    def errno_is_readable(self, pid):
+        key = get_pid_binary_identity(pid)
+        if key not in self.errno_readable:
+            self.errno_readable[key] = errno_is_readable(pid=pid,
+                                                         runcmd=self.runcmd)
+        return self.errno_readable[key]
+
+
 def run_gdb_cmd_in_pid_with_errno(command, pid, runcmd=_gdb_runner):
     argv = ['--quiet', '--pid', str(pid), '--batch',
             '--eval-command', 'output (int[2]){%s, errno}' % command]
@@ -116,22 +233,59 @@ def run_gdb_cmd_in_pid_without_errno(command, pid, runcmd=_gdb_runner):
     return ecode, None
 
 
-def migrate_process(pid, new_root, gdbcmd=_gdb_runner):
-    if not is_ptraceable(pid=pid, runcmd=gdbcmd):
-        warnings.warn('Pid %d is not ptraceable' % pid)
-        return
-    run_gdb = partial(run_gdb_cmd_in_pid_with_errno, pid=pid, runcmd=gdbcmd)
-    if not errno_is_readable(pid=pid, runcmd=gdbcmd):
+def _gdb_cmd_runner(pid, gdbcmd, caps):
+    if not caps.errno_is_readable(pid):
         warnings.warn('Cannot read errno from pid %d' % pid)
-        run_gdb = partial(run_gdb_cmd_in_pid_without_errno, pid=pid,
-                          runcmd=gdbcmd)
+        return partial(run_gdb_cmd_in_pid_without_errno, pid=pid,
+                       runcmd=gdbcmd)
+    return partial(run_gdb_cmd_in_pid_with_errno, pid=pid, runcmd=gdbcmd)
+
+
+def _escaped_path(path):
+    # Path to `path` in our root from any root that has our /proc mounted
+    return os.path.join('/proc', str(os.getpid()), 'root', path.lstrip('/'))
+
+
+def _path_from_root(path, root):
+    '''Return how a process chrooted to `root` can refer to our `path`.'''
+    if path == root or path.startswith(root.rstrip('/') + '/'):
+        return os.path.join('/', os.path.relpath(path, root))
+    return _escaped_path(path)
+
+
+def migrate_process(pid, new_root, gdbcmd=_gdb_runner, caps=None):
+    '''Move `pid`'s root, cwd and directory fds into `new_root`.
+
+    `new_root` is a copy of our root, so a process chrooted to a
+    subdirectory is chrooted to the same subdirectory of `new_root`. If
+    that isn't reachable from the process' root then it is found through
+    our own root in /proc, which needs the same /proc in both.
+
+    Returns a record of the process' previous state and the steps taken,
+    suitable for passing to revert_process, or None if the process could
+    not be migrated.
+
+    When migrating many processes, pass a CapabilityCache as `caps` to
+    avoid probing every process with gdb.
+
+    '''
+    if caps is None:
+        caps = CapabilityCache(runcmd=gdbcmd)
+    if not caps.is_ptraceable(pid):
+        warnings.warn('Pid %d is not ptraceable' % pid)
+        return None
+    run_gdb = _gdb_cmd_runner(pid, gdbcmd, caps)
     old_root = get_pid_root(pid)
-    if not new_root.startswith(old_root):
-        raise Exception('New root not reachable from old root')
+    pid_new_root = os.path.normpath(os.path.join(new_root,
+                                                 old_root.lstrip('/')))
 
     old_cwd = get_pid_cwd(pid)
     old_dir_fds = get_pid_dir_fds(pid)
     old_dir_fds = tuple(old_dir_fds)
+    record = {'pid': pid, 'starttime': get_pid_starttime(pid),
+              'old_root': old_root, 'old_cwd': old_cwd,
+              'old_dir_fds': old_dir_fds, 'new_root': pid_new_root,
+              'steps': []}
 
     #reopen dirfds
     for fileno, path in old_dir_fds:
@@ -139,7 +293,7 @@ def migrate_process(pid, new_root, gdbcmd=_gdb_runner):
         # get path to new version of file
         newpath = os.path.join(new_root, path.lstrip('/'))
         # translate new path to inside chroot
-        relpath = os.path.join('/', newpath[len(old_root):])
+        relpath = _path_from_root(newpath, old_root)
         newfd, cmderrno = run_gdb('open(%s, %#o)' %
                                   (cescape(relpath), O_DIRECTORY))
         if newfd < 0:
@@ -153,20 +307,112 @@ def migrate_process(pid, new_root, gdbcmd=_gdb_runner):
         if res < 0:
             warnings.warn('Failed to close new dir fd %s: %s' %
                           (newfd))
+        record['steps'].append(('dup2', fileno, relpath))
 
     #chroot
-    if old_root != new_root:
-        relative_root = os.path.join('/', os.path.relpath(new_root, old_root))
+    if old_root != pid_new_root:
+        relative_root = _path_from_root(pid_new_root, old_root)
         res, cmderrno = run_gdb('chroot(%s)' % cescape(relative_root))
         if res != 0:
             if cmderrno == errno.EPERM:
                 warnings.warn('Process %d has insufficient privileges to chroot' % pid)
             else:
                 raise Exception('chroot failed unexpectedly')
+        else:
+            record['steps'].append(('chroot', relative_root))
 
     #chdir
     relative_cwd = os.path.join('/', os.path.relpath(old_cwd, old_root))
     res, cmderrno = run_gdb('chdir(%s)' % cescape(relative_cwd))
+    if res != 0:
+        # Left for verification to find, rather than abandoning the rest
+        warnings.warn('Pid %d failed to chdir to %s: %s'
+                      % (pid, relative_cwd, os.strerror(cmderrno or 0)))
+    else:
+        record['steps'].append(('chdir', relative_cwd))
+    return record
+
+
+def revert_process(record, gdbcmd=_gdb_runner, caps=None):
+    '''Move a process back to the root it had before migrate_process.
+
+    `record` is the value returned by migrate_process. The old root may no
+    longer be reachable from the process' root, so it is found through
+    our own root in /proc, which needs the same /proc in both.
+
+    '''
+    pid = record['pid']
+    try:
+        starttime = get_pid_starttime(pid)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        starttime = None
+    if starttime != record['starttime']:
+        warnings.warn('Pid %d has exited, not reverting' % pid)
+        return
+    if any(step[0] == 'cooperative' for step in record['steps']):
+        # It moved itself, so can move itself back
+        from .cooperative import revert_cooperatively
+        return revert_cooperatively(record)
+    if caps is None:
+        caps = CapabilityCache(runcmd=gdbcmd)
+    run_gdb = _gdb_cmd_runner(pid, gdbcmd, caps)
+    old_root = record['old_root']
+    escaped_root = _escaped_path(old_root)
+
+    for fileno, path in record['old_dir_fds']:
+        O_DIRECTORY = 0200000
+        escaped_path = _escaped_path(path)
+        newfd, cmderrno = run_gdb('open(%s, %#o)' %
+                                  (cescape(escaped_path), O_DIRECTORY))
+        if newfd < 0:
+            raise Exception('Opening old dir fd failed: %s' %
+                            os.strerror(cmderrno))
+        res, cmderrno = run_gdb('dup2(%d, %d)' % (newfd, fileno))
+        if res < 0:
+            raise Exception('Replacing dir fd failed: %s' %
+                            os.strerror(cmderrno))
+        run_gdb('close(%d)' % newfd)
+
+    # Already back if it was moved by pivoting back
+    if get_pid_root(pid) != old_root:
+        res, cmderrno = run_gdb('chroot(%s)' % cescape(escaped_root))
+        if res != 0:
+            raise Exception('Reverting root of pid %d failed' % pid)
+
+    relative_cwd = os.path.join('/', os.path.relpath(record['old_cwd'],
+                                                     old_root))
+    res, cmderrno = run_gdb('chdir(%s)' % cescape(relative_cwd))
+    if res != 0:
+        raise Exception('Reverting cwd of pid %d to %s failed: %s'
+                        % (pid, relative_cwd, os.strerror(cmderrno or 0)))
+
+
+def revert_processes(records, gdbcmd=_gdb_runner, caps=None):
+    '''Revert every process in `records`.
+
+    Pivoting back to the old root moves the roots of processes whose root
+    was the new tree's root, but not their cwds or directory fds, which are
+    still in the new tree, so those are always restored. revert_process
+    only chroots processes whose root isn't already the old one.
+
+    A process that fails to revert doesn't stop the rest being reverted,
+    and an exception naming every failure is raised at the end.
+
+    '''
+    if caps is None:
+        caps = CapabilityCache(runcmd=gdbcmd)
+    failures = []
+    for record in records:
+        try:
+            revert_process(record, gdbcmd=gdbcmd, caps=caps)
+        except Exception as e:
+            logging.error('Reverting pid %d failed: %s' % (record['pid'], e))
+            failures.append('pid %d: %s' % (record['pid'], e))
+    if failures:
+        raise Exception('Reverting %d processes failed: %s'
+                        % (len(failures), '; '.join(failures)))
 
 
 def run():
@@ -176,7 +422,10 @@ def run():
     if opts.debug:
         logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    migrate_process(pid=opts.pid, new_root=opts.root)
+    with profiled(opts.profile):
+        with phase('processes'):
+            migrate_process(pid=opts.pid, new_root=opts.root,
+                            gdbcmd=waiting('ptrace', _gdb_runner))
 
 if __name__ == '__main__':
     run()
@@ -19,32 +19,266 @@
 '''Migrate process in a chroot in a namespace to a new root'''
 
 
+import errno
 import os
+import tempfile
+import time
 
-from .genmounts import generate_mount_commands
-from .migrate_process import migrate_process
+from .cooperative import migrate_cooperatively, CooperativeMoveFailed
+from .events import EventStream
+from .genmounts import plan_mount_commands
+from .journal import RootProgress
+from .migrate_process import (migrate_process, get_pid_starttime,
+                              revert_process, revert_processes,
+                              CapabilityCache)
 from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
-from .mount_tree import mount_tree
+from .mount_tree import mount_tree, remove_tree, MountTree
+from .prewarm import prewarm
+from .profiling import phase
+from .verify import verify_and_requeue
+from .ll.open_tree import (open_tree, move_mount, AT_RECURSIVE,
+                           OPEN_TREE_CLONE, OPEN_TREE_CLOEXEC)
+from .ll.pivot_root import pivot_root
+
+
+__all__ = ('migrate_root', 'RetainedRoot')
+
+
+class RetainedRoot(object):
+    '''Handle on the old root of a migration, kept so it can be reverted.
+
+    The old root is kept as a detached copy of its mount tree, which pins
+    the old filesystems until either `revert()` or `commit()` is called.
+
+    '''
+    def __init__(self, tree_fd, processes):
+        self.tree_fd = tree_fd
+        self.processes = processes
+
+    def revert(self, umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd):
+        '''Move the namespace and migrated processes back to the old root.
+
+        This must be run inside the namespace that was migrated.
+
+        '''
+        old_root = tempfile.mkdtemp()
+        move_mount(self.tree_fd, old_root)
+        self.commit()
+        put_new = tempfile.mkdtemp(dir=os.path.join(old_root, 'tmp'))
+        old_root, put_new = pivot_root(new_root=old_root, put_old=put_new)
+        revert_processes(self.processes)
+        remove_tree(MountTree(root=put_new, mount_cmd=None,
+                              umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd))
+
+    def commit(self):
+        '''Release the old root, after which it can't be reverted.'''
+        if self.tree_fd is not None:
+            os.close(self.tree_fd)
+            self.tree_fd = None
 
 
 def migrate_root(root, pids, mount_list, replacements, mount_cmd=mount_cmd,
-                 umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd):
+                 umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                 progress=None, retain=False, prewarm_budget=None,
+                 snapshot=None, caps=None, events=None, staged_tree=None,
+                 exclude=(), requeue=1, strategy=None, cooperative=True,
+                 throttle=None):
     '''Migrate all pids in `pids` to `root`.
-    
+
+    `pids` may include processes chrooted inside `root`, which are chrooted
+    to the same place in the new tree.
+
     If this is to be run in a different mount namespace, then pass canned
     equivalents of the *_cmd fields, as the namespace may not contain the
     necessary commands.
 
-    '''
-    with mount_tree(findmnt_cmd=findmnt_cmd, umount_cmd=umount_cmd) as new_tree:
-        new_tree.mount(generate_mount_commands(mount_list=mount_list,
-                                               replace=replacements,
-                                               new_root=new_tree.root))
+    If `progress` is passed, it's a RootProgress from a MigrationJournal,
+    which is used to skip steps a previous run completed and to record the
+    steps this run completes. The new tree is left mounted on failure, so a
+    later run can resume or roll back.
+
+    If `retain` is True, then a RetainedRoot is returned, which can revert
+    the migration after this returns.
+
+    If `prewarm_budget` is not None, then up to that many bytes of the files
+    `pids` use are read from the new tree before migrating them.
+
+    If a MountSnapshot of the namespace is passed as `snapshot`, then it is
+    used instead of reading the mount table again, and is invalidated when
+    this changes mounts.
 
-        for pid in pids:
-            if pid == os.getpid():
-                continue
-            migrate_process(pid=pid, new_root=new_tree.root)
+    `caps` is a CapabilityCache, which can be shared between calls to avoid
+    probing the same executables again.
 
-        with new_tree.pivot() as put_old:
+    Progress is reported to `events`, if an EventStream is passed.
+
+    If `staged_tree` is passed, it is the path of an already mounted new
+    tree to switch to, which is left mounted if anything fails, and
+    `mount_list` and `replacements` are ignored.
+
+    `exclude` lists the targets that were left out of `mount_list`, so they
+    aren't copied along with the mounts they are under.
+
+    If a TreeStrategy is passed as `strategy`, then it chooses how the new
+    tree's mounts are made and how the old tree is torn down, and is told
+    how long building took.
+
+    If `cooperative` is True, then processes are asked to move themselves
+    if they listen for it, as described in migratelib.cooperative, and only
+    ptraced otherwise.
+
+    Before pivoting, migrated processes are checked to be in the new tree,
+    and those that aren't are reverted and migrated again, up to `requeue`
+    times.
+
+    If a Throttle is passed as `throttle`, then making mounts and migrating
+    processes are paced by it, and verification uses as many workers as it
+    allows. Pausing leaves processes split between the trees for longer.
+
+    '''
+    if progress is None:
+        progress = RootProgress()
+    if caps is None:
+        caps = CapabilityCache()
+    if events is None:
+        events = EventStream()
+    if progress.pivoted:
+        if not progress.detached:
+            put_old = MountTree(root=progress.put_old, mount_cmd=mount_cmd,
+                                umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                                snapshot=snapshot)
             put_old.unmount(detach=True)
+            progress.record('detached')
+        progress.record('complete')
+        return
+
+    if staged_tree is not None and progress.tree is None:
+        progress.record('tree-mounted', tree=staged_tree)
+
+    with mount_tree(mount_cmd=mount_cmd, findmnt_cmd=findmnt_cmd,
+                    umount_cmd=umount_cmd,
+                    snapshot=snapshot, tree_dir=progress.tree,
+                    cleanup=(progress.journal is None
+                             and staged_tree is None)) as new_tree:
+        if progress.tree is None:
+            with phase('plan'):
+                mounts = plan_mount_commands(mount_list=mount_list,
+                                             replace=replacements,
+                                             new_root=new_tree.root,
+                                             exclude=exclude)
+            events.emit('mounts-planned', root=root, mounts=len(mounts))
+            builder = None
+            if strategy is not None:
+                builder = strategy.choose(new_tree.root, len(mounts),
+                                          mount_cmd=mount_cmd,
+                                          umount_cmd=umount_cmd)
+                new_tree.mount_cmd = builder.mount_cmd
+                new_tree.umount_cmd = builder.umount_cmd
+                events.emit('strategy', root=root, method=builder.method,
+                            teardown=builder.teardown,
+                            reason=builder.reason)
+            start = time.time()
+            with phase('mount'):
+                new_tree.mount(mounts, throttle=throttle)
+            duration = time.time() - start
+            if builder is not None:
+                strategy.record(builder, len(mounts), duration)
+            events.emit('mounts-created', root=root, mounts=len(mounts),
+                        duration=duration,
+                        method=builder.method if builder else 'command')
+            progress.record('tree-mounted', tree=new_tree.root)
+
+        if prewarm_budget is not None:
+            with phase('prewarm'):
+                report = prewarm(pids, new_tree.root, budget=prewarm_budget)
+            events.emit('prewarm', root=root, budget=prewarm_budget,
+                        **report)
+
+        def migrate_pid(pid):
+            # Services that move themselves needn't be stopped by ptrace
+            if cooperative:
+                process = migrate_cooperatively(pid, new_tree.root)
+                if process is not None:
+                    return process, 'cooperative'
+            return (migrate_process(pid=pid, new_root=new_tree.root,
+                                    gdbcmd=caps.runcmd, caps=caps),
+                    'ptrace')
+
+        with phase('processes'):
+            events.pid_starting()
+            for pid in pids:
+                if pid == os.getpid():
+                    events.pid_finished(pid, 'skipped', reason='self')
+                    continue
+                try:
+                    starttime = get_pid_starttime(pid)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    events.pid_finished(pid, 'skipped', reason='exited')
+                    continue
+                if progress.is_migrated(pid, starttime):
+                    events.pid_finished(pid, 'skipped', reason='journal')
+                    continue
+                if throttle is not None:
+                    throttle.pace()
+                try:
+                    process, method = migrate_pid(pid)
+                except CooperativeMoveFailed as e:
+                    # It may have moved, so must be reverted with the rest
+                    progress.record('pid-migrated', process=e.record)
+                    events.pid_finished(pid, 'failed', error=str(e))
+                    raise
+                except Exception as e:
+                    events.pid_finished(pid, 'failed', error=str(e))
+                    raise
+                if process is not None:
+                    progress.record('pid-migrated', process=process)
+                    events.pid_finished(pid, 'migrated', method=method)
+                else:
+                    events.pid_finished(pid, 'skipped',
+                                        reason='not ptraceable')
+
+        def remigrate(record):
+            revert_process(record, gdbcmd=caps.runcmd, caps=caps)
+            try:
+                process, method = migrate_pid(record['pid'])
+            except CooperativeMoveFailed as e:
+                progress.record('pid-migrated', process=e.record)
+                raise
+            if process is not None:
+                progress.record('pid-migrated', process=process)
+            return process
+
+        with phase('verify'):
+            verification = verify_and_requeue(
+                progress.migrated, new_tree.root, remigrate, requeue=requeue,
+                workers=throttle.concurrency if throttle is not None
+                        else None)
+        events.emit('verified', root=root, checked=verification.checked,
+                    exited=len(verification.exited),
+                    stragglers=dict((str(pid), problems) for pid, problems
+                                    in verification.stragglers.iteritems()))
+
+        retained = None
+        with phase('pivot'), new_tree.pivot() as put_old:
+            progress.record('pivoted', put_old=put_old.root)
+            events.emit('pivot', root=root)
+            try:
+                if retain:
+                    tree_fd = open_tree(put_old.root, OPEN_TREE_CLONE
+                                                      | OPEN_TREE_CLOEXEC
+                                                      | AT_RECURSIVE)
+                    retained = RetainedRoot(
+                        tree_fd=tree_fd,
+                        processes=progress.migrated.values())
+                put_old.unmount(detach=True)
+            except BaseException:
+                progress.record('pivot-reverted')
+                if retained is not None:
+                    retained.commit()
+                raise
+            progress.record('detached')
+            events.emit('teardown', root=root, retained=retain)
+    progress.record('complete')
+    return retained
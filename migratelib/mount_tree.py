@@ -28,28 +28,51 @@ import tempfile
 
 from .findmnt import find_mounts, search_fields
 from .genmounts import generate_mount_commands
+from .locking import add_lock_arguments, locks_from_opts
 from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
+from .profiling import phase, waiting, profiled, add_profile_argument
 from .ll.pivot_root import pivot_root
 #import .replaceparser as replaceparser
 from . import replaceparser
 
 
-__all__ = ('mount_tree', 'mount_new_root')
+__all__ = ('mount_tree', 'mount_new_root', 'remove_tree', 'MountTree')
 
 
 class MountTree(object):
-    ''''''
-    def __init__(self, root, mount_cmd, umount_cmd, findmnt_cmd):
+    '''Tree of mounts under `root`.
+
+    If `snapshot` is a MountSnapshot, then mounts are looked up in that
+    rather than with findmnt, and it is invalidated when mounts change.
+
+    '''
+    def __init__(self, root, mount_cmd, umount_cmd, findmnt_cmd,
+                 snapshot=None):
         self.root = root
         self.mount_cmd = mount_cmd
         self.umount_cmd = umount_cmd
         self.findmnt_cmd = findmnt_cmd
+        self.snapshot = snapshot
+
+    def _mounts_changed(self):
+        if self.snapshot is not None:
+            self.snapshot.invalidate()
+
+    def mount(self, mountargs_list, throttle=None):
+        '''Make the mounts in `mountargs_list`.
 
-    def mount(self, mountargs_list):
-        for mountargs in mountargs_list:
-            if not os.path.exists(mountargs.target):
-                os.makedirs(mountargs.target)
-            self.mount_cmd(mountargs)
+        If a Throttle is passed as `throttle`, it paces them.
+
+        '''
+        try:
+            for mountargs in mountargs_list:
+                if throttle is not None:
+                    throttle.pace()
+                if not os.path.exists(mountargs.target):
+                    os.makedirs(mountargs.target)
+                self.mount_cmd(mountargs)
+        finally:
+            self._mounts_changed()
 
     @contextlib.contextmanager
     def pivot(self, tempdir='/tmp'):
@@ -66,36 +89,61 @@ class MountTree(object):
             logging.debug('%s does not exist!' % tempdir)
         with mount_tree(tempdir=tempdir, mount_cmd=self.mount_cmd,
                         umount_cmd=self.umount_cmd,
-                        findmnt_cmd=self.findmnt_cmd) as old_tree:
+                        findmnt_cmd=self.findmnt_cmd,
+                        snapshot=self.snapshot) as old_tree:
             try:
                 self.root, old_tree.root = pivot_root(new_root=self.root,
                                                       put_old=old_tree.root)
             except BaseException as e:
                 logging.error('Exception while pivoting: %s' % str(e))
                 raise
+            finally:
+                self._mounts_changed()
             try:
                 yield old_tree
             except BaseException as e:
                 logging.error('Exception while pivoted: %s' % str(e))
                 logging.info('Pivoting back')
-                self.root, old_tree.root = pivot_root(new_root=self.root,
-                                                      put_old=old_tree.root)
+                # The old tree is the root we pivot into this time, and
+                # the new tree is put back where it came from inside it
+                old_tree.root, self.root = pivot_root(new_root=old_tree.root,
+                                                      put_old=self.root)
+                self._mounts_changed()
+                raise
 
     def unmount(self, detach=False):
         mount = None
         try:
-            for mount in reversed(find_mounts(root=self.root,
-                                              runcmd=self.findmnt_cmd)):
+            if self.snapshot is not None:
+                root_mount = self.snapshot.mount_at(self.root)
+                mounts = [root_mount] if root_mount is not None else []
+            else:
+                mounts = find_mounts(root=self.root, runcmd=self.findmnt_cmd)
+            for mount in reversed(mounts):
                 self.umount_cmd(mount['TARGET'], detach=True)
         except subprocess.CalledProcessError as e:
             if mount is not None:
                 logging.error('Failed to umount %s while cleaning up mount tree'
                               % mount['TARGET'])
+        finally:
+            self._mounts_changed()
+
+
+def remove_tree(tree):
+    '''Detach all mounts of `tree` and remove its directory.'''
+    tree.unmount(detach=True)
+    try:
+        os.rmdir(tree.root)
+    except OSError as e:
+        logging.error('Failed to rmdir %s while '
+                      'cleaning up mount tree: %s'
+                      % (tree.root, e.strerror))
 
 
 @contextlib.contextmanager
 def mount_tree(tempdir=None, mount_cmd=mount_cmd, umount_cmd=umount_cmd,
-               findmnt_cmd=findmnt_cmd):
+               findmnt_cmd=findmnt_cmd, tree_dir=None, cleanup=True,
+               snapshot=None):
     '''Context for a mount tree that is cleaned up.
     
     `dir` can be passed to specify an alternative temporary directory
@@ -105,22 +153,27 @@ def mount_tree(tempdir=None, mount_cmd=mount_cmd, umount_cmd=umount_cmd,
     
     Any mounts under the returned tree are unmounted on exception, and left
     mounted on regular exit.
+
+    `tree_dir` can be passed to use an existing tree rather than a new
+    temporary directory, and `cleanup` can be set to False to leave the tree
+    mounted on exception, if something else is responsible for cleaning it.
+
+    `snapshot` is passed on to the MountTree.
     
     '''
-    tree_dir = tempfile.mkdtemp(dir=tempdir)
+    if tree_dir is None:
+        tree_dir = tempfile.mkdtemp(dir=tempdir)
     new_tree = MountTree(root=tree_dir, mount_cmd=mount_cmd,
-                         umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd)
+                         umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                         snapshot=snapshot)
     try:
         yield new_tree
     except BaseException as e:
         (etype, evalue, etrace) = sys.exc_info()
-        new_tree.unmount(detach=True)
-        try:
-            os.rmdir(new_tree.root)
-        except OSError as e:
-            logging.error('Failed to rmdir %s while '
-                          'cleaning up mount tree: %s'
-                          % (new_tree.root, e.strerror))
+        if cleanup:
+            remove_tree(new_tree)
+        else:
+            logging.info('Leaving %s mounted' % new_tree.root)
         raise etype, evalue, etrace
 
 
@@ -129,6 +182,8 @@ def create_arg_parser():
     ap = argparse.ArgumentParser(description=__doc__)
     ap.add_argument('--pid', type=int, default=None)
     ap.add_argument('--test', action='store_const', const=True, default=False)
+    add_lock_arguments(ap)
+    add_profile_argument(ap)
     replaceparser.extend_arg_parser(ap)
     return ap
 
@@ -143,12 +198,18 @@ def run():
                     '--mount-source', '/dev/sda', '--mount-type=btrfs',
                     '-osubvol=/systems/criu2/run', '-o', 'rw',
             ])
-    mount_list = find_mounts(task=opts.pid, fields=search_fields)
-
-    with mount_tree() as new_tree:
-        new_tree.mount(generate_mount_commands(mount_list, opts.replace,
-                                               new_root=new_tree.root))
-        print(new_tree.root)
+    namespace_inode = os.stat('/proc/%s/ns/mnt' % (opts.pid or 'self')).st_ino
+    with profiled(opts.profile), \
+         locks_from_opts(opts).roots(namespace_inode, ['/']):
+        mount_list = find_mounts(task=opts.pid, fields=search_fields,
+                                 runcmd=waiting('subprocess', findmnt_cmd))
+
+        with mount_tree(mount_cmd=waiting('subprocess', mount_cmd),
+                        umount_cmd=waiting('subprocess', umount_cmd)) \
+                as new_tree, phase('mount'):
+            new_tree.mount(generate_mount_commands(mount_list, opts.replace,
+                                                   new_root=new_tree.root))
+    print(new_tree.root)
 
 
 if __name__ == '__main__':
@@ -20,24 +20,53 @@
 
 
 import contextlib
+import errno
 import os
+import threading
 
-from .ll.nsenter import nsenter
+from .ll.nsenter import nsenter, pidfd_open, CLONE_NEWNS
 
 
-__all__ = ('Namespace',)
+__all__ = ('Namespace', 'MountNamespace', 'NamespacePool')
+
+
+# Namespaces entered by each thread, innermost last
+_entered = threading.local()
+
+
+def _entered_stack():
+    if not hasattr(_entered, 'stack'):
+        _entered.stack = []
+    return _entered.stack
+
+
+def _own_namespace_fobj():
+    # Opened once, as the namespace we started in doesn't change
+    if not hasattr(_own_namespace_fobj, 'fobj'):
+        _own_namespace_fobj.fobj = open('/proc/self/ns/mnt')
+    return _own_namespace_fobj.fobj
 
 
 class MountNamespace(object):
 
-    def __init__(self, mount_ns_fobj, mountinfo_fobj):
+    def __init__(self, mount_ns_fobj, mountinfo_fobj, pidfd=None):
         self.mount_ns_fobj = mount_ns_fobj
         self.mountinfo_fobj = mountinfo_fobj
         self.inode = os.fstat(mount_ns_fobj.fileno()).st_ino
+        # If set, entering through a pidfd is preferred, as it doesn't
+        # need /proc and can't refer to the wrong process if pids are reused
+        self.pidfd = pidfd
 
     @classmethod
     def from_pid(cls, pid):
         proc_path = '/proc/%d' % pid
+        try:
+            pidfd = pidfd_open(pid)
+        except OSError as e:
+            # Kernels before 5.3 don't have pidfd_open
+            if e.errno != errno.ENOSYS:
+                raise
+            pidfd = None
         ns_path = os.path.join(proc_path, 'ns', 'mnt')
         mount_ns_fobj = open(ns_path)
         # We're kind of screwed if processes change namespace out from under
@@ -45,7 +74,15 @@ class MountNamespace(object):
         # here anyway, since we're likely to get better diagnostics
         mountinfo_path = os.path.join(proc_path, 'mountinfo')
         mountinfo_fobj = open(mountinfo_path)
-        return cls(mount_ns_fobj=mount_ns_fobj, mountinfo_fobj=mountinfo_fobj)
+        return cls(mount_ns_fobj=mount_ns_fobj, mountinfo_fobj=mountinfo_fobj,
+                   pidfd=pidfd)
+
+    def close(self):
+        self.mount_ns_fobj.close()
+        self.mountinfo_fobj.close()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
 
     def __hash__(self):
         return hash(self.inode)
@@ -56,11 +93,68 @@ class MountNamespace(object):
     def __str__(self):
         return 'Namespace(%d)' % self.inode
 
+    def _enter(self):
+        if self.pidfd is not None:
+            try:
+                nsenter(self.pidfd, CLONE_NEWNS)
+                return
+            except OSError as e:
+                # Kernels before 5.8 don't take pidfds, and setns through
+                # one needs CAP_SYS_ADMIN over the process' user namespace
+                if e.errno in (errno.EINVAL, errno.EPERM):
+                    return nsenter(self.mount_ns_fobj.fileno())
+                # If the process has exited the namespace fd is still valid
+                if e.errno != errno.ESRCH:
+                    raise
+            os.close(self.pidfd)
+            self.pidfd = None
+        nsenter(self.mount_ns_fobj.fileno())
+
     @contextlib.contextmanager
     def entered(self):
-        current_ns = open('/proc/self/ns/mnt')
-        nsenter(self.mount_ns_fobj.fileno())
+        stack = _entered_stack()
+        previous_ns = stack[-1].mount_ns_fobj if stack else _own_namespace_fobj()
+        self._enter()
+        stack.append(self)
         try:
             yield
         finally:
-            nsenter(current_ns.fileno())
+            stack.pop()
+            nsenter(previous_ns.fileno())
+
+
+class NamespacePool(object):
+    '''Share one MountNamespace between all processes in that namespace.
+
+    Namespaces are looked up by inode, so only the first process seen in
+    each namespace needs files opened for it.
+
+    '''
+    def __init__(self):
+        self.namespaces = {}
+
+    def get(self, pid):
+        inode = os.stat('/proc/%d/ns/mnt' % pid).st_ino
+        if inode not in self.namespaces:
+            namespace = MountNamespace.from_pid(pid)
+            if namespace.inode in self.namespaces:
+                # Process changed namespace in the meantime
+                namespace.close()
+            else:
+                self.namespaces[namespace.inode] = namespace
+            inode = namespace.inode
+        return self.namespaces[inode]
+
+    def discard(self, inode):
+        self.namespaces.pop(inode).close()
+
+    def close(self):
+        for namespace in self.namespaces.itervalues():
+            namespace.close()
+        self.namespaces.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,283 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Slow migrations down when the host is under pressure.
+
+Pressure stall information (PSI) says what percentage of the time some
+tasks were stalled waiting for cpu, io or memory, for the whole host in
+/proc/pressure and for each cgroup v2 in its *.pressure files.
+
+A Throttle is told before each unit of work, such as migrating a process
+or making a mount, and pauses first if pressure is over its limits. The
+pause is doubled each time pressure is over a limit and shortened by a
+fixed step each time it's under, and once there's no pause, the number of
+workers for parallel work, such as verification, grows by one at a time,
+where it was halved when over. That's the same additive increase and
+multiplicative decrease TCP uses, so it quickly backs off when the host is
+busy, and cautiously returns to full speed.
+
+Pressure is measured over the time since the last sample from the files'
+stall totals, since the avg10 figures lag by several seconds, which would
+keep the pause growing long after it had relieved the pressure.
+
+'''
+
+
+import argparse
+import errno
+import logging
+import multiprocessing
+import os
+import time
+
+from .events import EventStream
+
+
+__all__ = ('PressureSource', 'Throttle', 'add_throttle_arguments',
+           'throttle_from_opts')
+
+
+resources = ('cpu', 'io', 'memory')
+
+# Percentage of the time some tasks may be stalled on each resource
+default_limits = {'cpu': 40.0, 'io': 20.0, 'memory': 10.0}
+
+
+def _parse_some(data):
+    '''Return the avg10 and total of the "some" line of a pressure file.'''
+    for line in data.splitlines():
+        fields = line.split()
+        if fields and fields[0] == 'some':
+            values = dict(field.split('=', 1) for field in fields[1:])
+            return float(values['avg10']), int(values['total'])
+    raise ValueError('No "some" line in %r' % data)
+
+
+def _open_pressure(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        logging.debug('No pressure information in %s' % path)
+        return None
+    try:
+        os.read(fd, 4096)
+    except OSError as e:
+        os.close(fd)
+        # With psi=0 the files exist but can't be read
+        if e.errno != errno.EOPNOTSUPP:
+            raise
+        logging.debug('Pressure information in %s is disabled' % path)
+        return None
+    return fd
+
+
+class PressureSource(object):
+    '''Read the pressure on the host, and on the cgroup v2 paths `cgroups`.
+
+    The files are opened when this is made, so it can still be read after
+    entering a namespace without them. Resources the kernel doesn't report
+    pressure for are left out, and if it reports none, `available` is
+    False.
+
+    '''
+    def __init__(self, cgroups=(), proc_dir='/proc/pressure',
+                 cgroup_root='/sys/fs/cgroup'):
+        self.files = [] # (resource, path, fd)
+        for cgroup in cgroups:
+            if not os.path.isdir(os.path.join(cgroup_root, cgroup.lstrip('/'))):
+                logging.warning('Cgroup %s does not exist, so its pressure '
+                                'is ignored' % cgroup)
+        for resource in resources:
+            paths = [os.path.join(proc_dir, resource)]
+            paths.extend(os.path.join(cgroup_root, cgroup.lstrip('/'),
+                                      resource + '.pressure')
+                         for cgroup in cgroups)
+            for path in paths:
+                fd = _open_pressure(path)
+                if fd is not None:
+                    self.files.append((resource, path, fd))
+        self.last = {} # fd -> (time, total)
+
+    @property
+    def available(self):
+        return bool(self.files)
+
+    def sample(self):
+        '''Return the highest percentage of time stalled on each resource.
+        '''
+        pressure = {}
+        now = time.time()
+        for resource, path, fd in self.files:
+            os.lseek(fd, 0, os.SEEK_SET)
+            avg10, total = _parse_some(os.read(fd, 4096))
+            if fd in self.last:
+                last_time, last_total = self.last[fd]
+                # Totals are in microseconds
+                percent = ((total - last_total) / 1e4
+                           / max(now - last_time, 1e-3))
+            else:
+                percent = avg10
+            self.last[fd] = now, total
+            pressure[resource] = max(pressure.get(resource, 0.0), percent)
+        return pressure
+
+    def close(self):
+        for resource, path, fd in self.files:
+            os.close(fd)
+        self.files = []
+
+
+class Throttle(object):
+    '''Pace work so pressure stays under `limits`.
+
+    `limits` maps resources to the percentage of time tasks may be stalled
+    on them. `pace()` is called before each unit of work, and sleeps for
+    `delay`, which is between 0 and `max_delay` seconds, while
+    `concurrency` is how many workers parallel work should use, between 1
+    and `max_concurrency`. Pressure is sampled from `source` at most once
+    every `sample_interval` seconds.
+
+    Each change is reported to `events` as a throttle event, and `summary()`
+    describes what was done.
+
+    '''
+    def __init__(self, limits=default_limits, source=None, max_delay=5.0,
+                 delay_step=0.05, max_concurrency=None, sample_interval=1.0,
+                 events=None, sleep=time.sleep):
+        self.limits = dict(limits)
+        self.source = PressureSource() if source is None else source
+        self.max_delay = max_delay
+        self.delay_step = delay_step
+        if max_concurrency is None:
+            max_concurrency = multiprocessing.cpu_count()
+        self.max_concurrency = max_concurrency
+        self.sample_interval = sample_interval
+        self.events = EventStream() if events is None else events
+        self.sleep = sleep
+        self.delay = 0.0
+        self.concurrency = max_concurrency
+        self.sampled = None
+        self.slept = 0.0
+        self.paces = 0
+        self.changes = 0
+        self.peak = {}
+        self.longest_delay = 0.0
+        self.least_concurrency = max_concurrency
+        if not self.source.available:
+            logging.warning('Not throttling, as the kernel reports no '
+                            'pressure stall information')
+
+    def _adjust(self, pressure):
+        for resource, percent in pressure.iteritems():
+            self.peak[resource] = max(self.peak.get(resource, 0.0), percent)
+        over = sorted(resource for resource, limit in self.limits.iteritems()
+                      if pressure.get(resource, 0.0) > limit)
+        delay, concurrency = self.delay, self.concurrency
+        if over:
+            delay = min(max(delay * 2, self.delay_step), self.max_delay)
+            concurrency = max(concurrency // 2, 1)
+        elif delay > 0:
+            delay = max(delay - self.delay_step, 0.0)
+            if delay < self.delay_step / 2:
+                # Rounding errors shouldn't leave a tiny pause
+                delay = 0.0
+        else:
+            concurrency = min(concurrency + 1, self.max_concurrency)
+        if (delay, concurrency) == (self.delay, self.concurrency):
+            return
+        self.delay, self.concurrency = delay, concurrency
+        self.changes += 1
+        self.longest_delay = max(self.longest_delay, delay)
+        self.least_concurrency = min(self.least_concurrency, concurrency)
+        rounded = dict((resource, round(percent, 2))
+                       for resource, percent in pressure.iteritems())
+        if over:
+            logging.info('Pausing %.2fs between steps with %d workers, as '
+                         'pressure is over the limits for %s: %s'
+                         % (delay, concurrency, ', '.join(over), rounded))
+        self.events.emit('throttle', delay=delay, concurrency=concurrency,
+                         pressure=rounded, over=over)
+
+    def pace(self):
+        '''Wait for as long as pressure says to before the next step.'''
+        if not self.source.available:
+            return
+        self.paces += 1
+        now = time.time()
+        if self.sampled is None or now - self.sampled >= self.sample_interval:
+            self.sampled = now
+            self._adjust(self.source.sample())
+        if self.delay > 0:
+            self.sleep(self.delay)
+            self.slept += self.delay
+
+    def summary(self):
+        return {
+            'available': self.source.available,
+            'limits': self.limits,
+            'steps': self.paces,
+            'changes': self.changes,
+            'slept': self.slept,
+            'longest_delay': self.longest_delay,
+            'least_concurrency': self.least_concurrency,
+            'peak_pressure': dict((resource, round(percent, 2))
+                                  for resource, percent
+                                  in self.peak.iteritems()),
+        }
+
+
+def _limit(value):
+    resource, _, percent = value.partition('=')
+    try:
+        if resource not in resources:
+            raise ValueError('%s is not one of %s'
+                             % (resource, ', '.join(resources)))
+        return resource, float(percent)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def add_throttle_arguments(ap):
+    '''Add the options read by throttle_from_opts to `ap`.'''
+    ap.add_argument('--throttle', action='store_true', default=False,
+                    help='Slow down when pressure stall information shows '
+                         'the host is busy')
+    ap.add_argument('--pressure-limit', action='append', type=_limit,
+                    default=[], metavar='RESOURCE=PERCENT',
+                    help='Throttle when tasks are stalled on cpu, io or '
+                         'memory for more than this much of the time, '
+                         'implying --throttle (defaults: %s)'
+                         % ', '.join('%s=%g' % pair for pair
+                                     in sorted(default_limits.iteritems())))
+    ap.add_argument('--pressure-cgroup', action='append', default=[],
+                    help='Throttle on the pressure in this cgroup v2 path '
+                         'too, such as that of the production workload')
+    ap.add_argument('--max-pause', type=float, default=5.0,
+                    metavar='SECONDS',
+                    help='Longest pause to throttle with between steps')
+
+
+def throttle_from_opts(opts, events=None):
+    '''Return the Throttle the options ask for, or None.'''
+    if not (opts.throttle or opts.pressure_limit):
+        return None
+    limits = dict(default_limits)
+    limits.update(opts.pressure_limit)
+    return Throttle(limits=limits,
+                    source=PressureSource(cgroups=opts.pressure_cgroup),
+                    max_delay=opts.max_pause, events=events)
@@ -0,0 +1,150 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Load the files processes use from a new root into the page cache.
+
+Processes migrated into a new root keep using the files they already have
+mapped, but anything they execute or load afterwards comes from the new
+root, which is probably not cached yet.
+
+'''
+
+
+import errno
+import logging
+import os
+import stat
+from multiprocessing.pool import ThreadPool
+
+from .ll.fadvise import posix_fadvise, POSIX_FADV_WILLNEED
+
+
+__all__ = ('find_pid_files', 'prewarm')
+
+
+def find_pid_files(pid):
+    '''Yield the paths of the executable and files mapped by `pid`.
+
+    Paths are relative to our root, rather than the process'.
+
+    '''
+    proc_path = os.path.join('/proc', str(pid))
+    try:
+        yield os.readlink(os.path.join(proc_path, 'exe'))
+    except OSError as e:
+        # Kernel threads have no executable
+        if e.errno != errno.ENOENT:
+            raise
+    with open(os.path.join(proc_path, 'maps')) as maps:
+        for line in maps:
+            # address perms offset dev inode path
+            fields = line.split(None, 5)
+            if len(fields) < 6:
+                continue
+            path = fields[5].rstrip('\n')
+            # Skip [heap], [stack] etc. and files since replaced
+            if path.startswith('/') and not path.endswith(' (deleted)'):
+                yield path
+
+
+# Errors from files that changed since they were found, which don't stop
+# the others being prewarmed
+_file_errors = (errno.ENOENT, errno.EACCES, errno.EPERM)
+
+
+def _prewarm_file(path):
+    '''Read ahead `path`, returning the error that stopped it, if any.'''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno not in _file_errors:
+            raise
+        return e.strerror
+    try:
+        posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return None
+
+
+def prewarm(pids, new_root, budget=None, workers=8):
+    '''Ask for the new versions of files used by `pids` to be read ahead.
+
+    Files are taken in the order processes use them, and any which would
+    take the total past `budget` bytes are skipped. Returns a dict
+    reporting how many files and bytes were loaded, and how many files
+    were skipped, missing, or failed to be read.
+
+    '''
+    paths = []
+    seen = set()
+    for pid in pids:
+        try:
+            for path in find_pid_files(pid):
+                if path not in seen:
+                    seen.add(path)
+                    paths.append(path)
+        except (IOError, OSError) as e:
+            # Prewarming is only an optimisation, so processes which exit
+            # or that we can't inspect don't need to stop it
+            if e.errno not in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+                raise
+            logging.debug('Not prewarming files of pid %d: %s'
+                          % (pid, e.strerror))
+
+    report = {'files': 0, 'bytes': 0, 'skipped': 0, 'missing': 0,
+              'failed': 0}
+    to_load = []
+    for path in paths:
+        new_path = os.path.join(new_root, path.lstrip('/'))
+        try:
+            st = os.stat(new_path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                report['missing'] += 1
+                continue
+            if e.errno not in _file_errors:
+                raise
+            logging.debug('Not prewarming %s: %s' % (new_path, e.strerror))
+            report['failed'] += 1
+            continue
+        # Mapped devices have nothing to read ahead
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        size = st.st_size
+        if budget is not None and report['bytes'] + size > budget:
+            report['skipped'] += 1
+            continue
+        report['files'] += 1
+        report['bytes'] += size
+        to_load.append((new_path, size))
+
+    pool = ThreadPool(workers)
+    try:
+        errors = pool.map(_prewarm_file, [path for path, size in to_load])
+    finally:
+        pool.close()
+        pool.join()
+    for (path, size), error in zip(to_load, errors):
+        if error is not None:
+            logging.debug('Not prewarming %s: %s' % (path, error))
+            report['files'] -= 1
+            report['bytes'] -= size
+            report['failed'] += 1
+    logging.info('Prewarmed %(files)d files, %(bytes)d bytes, skipped '
+                 '%(skipped)d over budget, %(missing)d missing and '
+                 '%(failed)d failed' % report)
+    return report
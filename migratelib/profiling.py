@@ -0,0 +1,240 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Profile where a migration spends its time, phase by phase.
+
+Library code marks phases with `with phase('name'):`, and wraps commands it
+waits for with `waiting('category', func)`. Both do nothing unless a run is
+`profiled()`, in which case each phase gets its own cProfile profile and
+stack samples of its CPU time, and time spent waiting for commands is
+counted per category rather than as the phase's own.
+
+Phases nest, and time is counted against the innermost, so a phase's
+figures don't include those of phases inside it. Time outside any phase is
+counted against "main".
+
+Writing a profile to a directory produces, for each phase, NAME.pstats for
+the pstats module and NAME.collapsed, which is the folded stack format
+flamegraph.pl takes, plus summary.json with the wall clock, CPU and
+waiting time of every phase.
+
+'''
+
+
+import collections
+import contextlib
+import cProfile
+import errno
+import json
+import logging
+import os
+import signal
+import time
+
+
+__all__ = ('phase', 'waiting', 'profiled', 'add_profile_argument')
+
+
+_profiler = None
+
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_no_phase = _NoPhase()
+
+
+def phase(name):
+    '''Context in which time is counted against phase `name`.'''
+    if _profiler is None:
+        return _no_phase
+    return _profiler.phase(name)
+
+
+def waiting(category, func):
+    '''Wrap `func`, so time spent in it is counted as waiting on `category`.
+
+    When not profiling `func` is returned as it is, so this costs nothing.
+
+    '''
+    if _profiler is None:
+        return func
+    profiler = _profiler
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.waited(category, time.time() - start)
+    return wrapper
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+
+class _PhaseStats(object):
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.stacks = collections.Counter()
+        self.waits = collections.Counter()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.entered = 0
+
+
+class Profiler(object):
+    '''Collects profiles by phase, sampling stacks every `interval` seconds
+    of CPU time.'''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.phases = collections.defaultdict(_PhaseStats)
+        self.stack = []
+
+    def _switch(self, name):
+        # Charge the time since the last switch to the current phase
+        now, cpu = time.time(), _cpu_time()
+        current = self.phases[self.stack[-1]] if self.stack else None
+        if current is not None:
+            current.profile.disable()
+            current.wall += now - self.last_wall
+            current.cpu += cpu - self.last_cpu
+        self.last_wall, self.last_cpu = now, cpu
+        if name is not None:
+            self.phases[name].profile.enable()
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if self.stack:
+            self.phases[self.stack[-1]].stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self.stack.append('main')
+        self.phases['main'].entered += 1
+        self.last_wall, self.last_cpu = time.time(), _cpu_time()
+        self.phases['main'].profile.enable()
+        self.old_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Restart interrupted system calls, rather than failing with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.old_handler)
+        self._switch(None)
+        self.stack = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._switch(name)
+        self.stack.append(name)
+        self.phases[name].entered += 1
+        try:
+            yield
+        finally:
+            # Charge this phase before returning to the one it's inside
+            self._switch(self.stack[-2] if len(self.stack) > 1 else None)
+            self.stack.pop()
+
+    def waited(self, category, duration):
+        if self.stack:
+            self.phases[self.stack[-1]].waits[category] += duration
+
+    def summary(self):
+        summary = {}
+        for name, stats in self.phases.iteritems():
+            waiting = sum(stats.waits.itervalues())
+            summary[name] = {
+                'entered': stats.entered,
+                'wall': stats.wall,
+                'cpu': stats.cpu,
+                'waits': dict(stats.waits),
+                # Neither our CPU nor a command we wrapped, such as reading
+                # /proc or waiting for unwrapped commands
+                'other': max(stats.wall - stats.cpu - waiting, 0.0),
+                'samples': sum(stats.stacks.itervalues()),
+            }
+        return summary
+
+    def write(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        for name, stats in self.phases.iteritems():
+            stats.profile.dump_stats(os.path.join(directory,
+                                                  name + '.pstats'))
+            with open(os.path.join(directory, name + '.collapsed'), 'w') as f:
+                for stack, count in sorted(stats.stacks.iteritems()):
+                    f.write('%s %d\n' % (stack, count))
+        summary = self.summary()
+        with open(os.path.join(directory, 'summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        for name, stats in sorted(summary.iteritems(),
+                                  key=lambda item: item[1]['wall'],
+                                  reverse=True):
+            logging.info('Phase %s: %.3fs wall, %.3fs CPU, waiting %s'
+                         % (name, stats['wall'], stats['cpu'],
+                            ', '.join('%.3fs on %s' % (duration, category)
+                                      for category, duration
+                                      in sorted(stats['waits'].iteritems()))
+                            or 'on nothing'))
+
+
+@contextlib.contextmanager
+def profiled(directory, interval=0.005):
+    '''Profile the context, and write the profiles to `directory`.
+
+    If `directory` is None then nothing is profiled.
+
+    '''
+    global _profiler
+    if directory is None:
+        yield None
+        return
+    profiler = Profiler(interval=interval)
+    _profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _profiler = None
+        profiler.write(directory)
+        logging.info('Wrote profiles to %s' % directory)
+
+
+def add_profile_argument(ap):
+    '''Add the --profile option to `ap`.'''
+    ap.add_argument('--profile', metavar='DIR', default=None,
+                    help='Profile each phase of the run, writing the '
+                         'profiles to this directory')
@@ -33,19 +33,29 @@ def extend_arg_parser(ap, argnames=('--replace',), dest='replace'):
     replaceparser.add_argument('--mount-type')
     replaceparser.add_argument('--mount-options', '-o', nargs='*', action='append',
                                default=[])
+    replaceparser.add_argument('--overlay-upper')
+    replaceparser.add_argument('--overlay-work')
+
+    def replacement(parser, subns):
+        mount_options = tuple(flatten(subns.mount_options))
+        if subns.overlay_upper is None and subns.overlay_work is None:
+            return (subns.mount_source, subns.mount_type, mount_options)
+        if subns.overlay_upper is None or subns.overlay_work is None:
+            parser.error('--overlay-upper and --overlay-work must be '
+                         'given together')
+        if subns.mount_type not in (None, 'overlay'):
+            parser.error('--overlay-upper can\'t be used with --mount-type %s'
+                         % subns.mount_type)
+        # genmounts adds the replaced mount as the lower layer
+        return ('overlay', 'overlay',
+                ('upperdir=' + subns.overlay_upper,
+                 'workdir=' + subns.overlay_work) + mount_options)
 
     class RecursiveReplaceAction(argparse.Action):
         def __call__(self, subparser, subnamespace, values, option_string=None):
-            subns, unparsed = replaceparser.parse_known_args(args=values)
-
-            filters = frozenset(tuple(filter.split('=', 1))
-                                for filter in sorted(flatten(subns.filter)))
-            mount_options = tuple(flatten(subns.mount_options))
-
-            replacements = getattr(subnamespace, self.dest)
-            replacements[filters] = (subns.mount_source, subns.mount_type, mount_options)
-
-            subnamespace._unrecognized_args = unparsed
+            # Hand the next replacement back to the top-level parser, since
+            # one recorded in this namespace would be lost
+            subnamespace._unrecognized_args = [option_string] + values
 
     replaceparser.add_argument(*argnames, dest=dest, nargs=argparse.REMAINDER,
                                action=RecursiveReplaceAction, default={})
@@ -56,10 +66,9 @@ def extend_arg_parser(ap, argnames=('--replace',), dest='replace'):
 
             filters = frozenset(tuple(filter.split('=', 1))
                                 for filter in sorted(flatten(subns.filter)))
-            mount_options = tuple(flatten(subns.mount_options))
 
             replacements = getattr(namespace, self.dest)
-            replacements[filters] = (subns.mount_source, subns.mount_type, mount_options)
+            replacements[filters] = replacement(parser, subns)
             parser.parse_args(args=unparsed, namespace=namespace)
 
     ap.add_argument(*argnames, dest=dest, nargs=argparse.REMAINDER,
@@ -78,12 +87,18 @@ def test():
            -o subvol=/systems/foo/run
         --rep --filter TARGET=/home --mount-source /dev/vda --mount-type btrfs
            -o subvol=/state/home
+        -r --filter TARGET=/usr --overlay-upper /run/update/upper
+           --overlay-work /run/update/work
         --foo=bar
         a b 'c d'
     '''))
 
     assert opts.foo == 'bar'
     assert opts.bars == ['a', 'b', 'c d']
+    assert len(opts.reps) == 3
+    assert opts.reps[frozenset([('TARGET', '/usr')])] == (
+        'overlay', 'overlay', ('upperdir=/run/update/upper',
+                               'workdir=/run/update/work'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Build new mount trees ahead of time, and switch to them later.
+
+Staging a tree mounts it in a private temporary directory of the namespace
+and records it in a state directory. Switching then only needs to migrate
+processes into the staged tree and pivot, as long as the mounts it was
+built from haven't changed in the meantime.
+
+'''
+
+
+import errno
+import json
+import logging
+import os
+import tempfile
+import time
+
+from .list_processes import pids_in_namespaces
+from .locking import MigrationLocks
+from .migrate_namespace import namespace_snapshot, find_root_mounts
+from .migrate_process import CapabilityCache
+from .migrate_root import migrate_root
+from .mount_commands import mount_cmd, umount_cmd, findmnt_cmd
+from .mount_tree import mount_tree, remove_tree, MountTree
+from .genmounts import plan_mount_commands
+from .namespace import NamespacePool
+
+
+__all__ = ('stage_tree', 'list_staged', 'discard_staged', 'switch_staged')
+
+
+default_state_dir = '/run/migratelib/staged'
+
+
+def _mount_signature(mount_list):
+    # Enough to tell if a mount has been replaced, remounted or added
+    return [[mount['ID'], mount['TARGET'], mount['SOURCE'], mount['FSTYPE']]
+            for mount in mount_list]
+
+
+def _record_path(name, state_dir):
+    return os.path.join(state_dir, name + '.json')
+
+
+def _read_record(path):
+    with open(path) as f:
+        record = json.load(f)
+    # json gives unicode, which ctypes would pass to syscalls as wide strings
+    for key in ('name', 'root', 'tree'):
+        record[key] = str(record[key])
+    return record
+
+
+def list_staged(state_dir=default_state_dir, namespace=None):
+    '''Return the records of staged trees, optionally only in `namespace`.'''
+    try:
+        names = sorted(os.listdir(state_dir))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    staged = []
+    for filename in names:
+        if not filename.endswith('.json'):
+            continue
+        record = _read_record(os.path.join(state_dir, filename))
+        if namespace is None or record['namespace'] == namespace.inode:
+            staged.append(record)
+    return staged
+
+
+def _staged_trees(namespace, state_dir):
+    return [record['tree']
+            for record in list_staged(state_dir=state_dir,
+                                      namespace=namespace)]
+
+
+def stage_tree(namespace, root, replacements, name=None,
+               state_dir=default_state_dir, mount_cmd=mount_cmd,
+               umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd, locks=None):
+    '''Build the new tree for `root` in `namespace`, and record it.
+
+    The tree is checked to contain a mount for every mount planned. Returns
+    the record of the staged tree.
+
+    `root` is locked while its tree is built, if a MigrationLocks is passed
+    as `locks`.
+
+    '''
+    if locks is None:
+        locks = MigrationLocks(lock_dir=None)
+    if name is None:
+        name = '%d-%s' % (namespace.inode, time.strftime('%Y%m%dT%H%M%S'))
+    record_path = _record_path(name, state_dir)
+    if os.path.exists(record_path):
+        raise Exception('Staged tree %s already exists' % name)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    # Other staged trees shouldn't be replicated into this one
+    exclude = _staged_trees(namespace, state_dir)
+
+    with locks.roots(namespace.inode, [root]), namespace.entered():
+        snapshot = namespace_snapshot(namespace, findmnt_cmd=findmnt_cmd)
+        mount_list = find_root_mounts(snapshot, root, exclude=exclude)
+        tempdir = tempfile.mkdtemp(prefix='migratelib-staged-')
+        with mount_tree(tempdir=tempdir, mount_cmd=mount_cmd,
+                        umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                        snapshot=snapshot) as new_tree:
+            mounts = plan_mount_commands(mount_list=mount_list,
+                                         replace=replacements,
+                                         new_root=new_tree.root,
+                                         exclude=exclude)
+            new_tree.mount(mounts)
+            mounted = set(mount['TARGET']
+                          for mount in snapshot.submounts(new_tree.root))
+            missing = [mountargs.target for mountargs in mounts
+                       if os.path.normpath(mountargs.target) not in mounted]
+            if missing:
+                raise Exception('Staged tree is missing mounts: %s'
+                                % ', '.join(missing))
+
+    record = {
+        'name': name,
+        'namespace': namespace.inode,
+        'root': root,
+        'tree': new_tree.root,
+        'created': time.time(),
+        'mounts': len(mounts),
+        'source': _mount_signature(mount_list),
+    }
+    with open(record_path, 'w') as f:
+        json.dump(record, f)
+    logging.info('Staged %s at %s' % (name, new_tree.root))
+    return record
+
+
+def _load_record(name, state_dir):
+    return _read_record(_record_path(name, state_dir))
+
+
+def discard_staged(namespace, name, state_dir=default_state_dir,
+                   umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd):
+    '''Unmount the staged tree called `name` and forget about it.'''
+    record = _load_record(name, state_dir)
+    with namespace.entered():
+        remove_tree(MountTree(root=record['tree'], mount_cmd=None,
+                              umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd))
+        # The temporary directory it was made in
+        try:
+            os.rmdir(os.path.dirname(record['tree']))
+        except OSError as e:
+            logging.warning('Failed to remove %s: %s'
+                            % (os.path.dirname(record['tree']), e.strerror))
+    os.unlink(_record_path(name, state_dir))
+
+
+def switch_staged(namespace, name, pids, state_dir=default_state_dir,
+                  mount_cmd=mount_cmd, umount_cmd=umount_cmd,
+                  findmnt_cmd=findmnt_cmd, force=False, locks=None, **kwargs):
+    '''Migrate `pids` into the staged tree called `name`, and pivot to it.
+
+    If the mounts the tree was built from have changed since it was staged
+    then this fails, unless `force` is True. The root is locked with
+    `locks`, if a MigrationLocks is passed. Other keyword arguments are
+    passed on to migrate_root.
+
+    '''
+    if locks is None:
+        locks = MigrationLocks(lock_dir=None)
+    record = _load_record(name, state_dir)
+    exclude = [tree for tree in _staged_trees(namespace, state_dir)
+               if tree != record['tree']] + [record['tree']]
+    with locks.namespace(namespace.inode), \
+         locks.roots(namespace.inode, [record['root']]), \
+         namespace.entered():
+        snapshot = namespace_snapshot(namespace, findmnt_cmd=findmnt_cmd)
+        mount_list = find_root_mounts(snapshot, record['root'],
+                                      exclude=exclude)
+        if _mount_signature(mount_list) != record['source']:
+            if not force:
+                raise Exception('Mounts under %s have changed since %s was '
+                                'staged' % (record['root'], name))
+            logging.warning('Mounts under %s have changed since %s was '
+                            'staged' % (record['root'], name))
+        retained = migrate_root(record['root'], pids, mount_list=None,
+                                replacements=None, mount_cmd=mount_cmd,
+                                umount_cmd=umount_cmd,
+                                findmnt_cmd=findmnt_cmd, snapshot=snapshot,
+                                staged_tree=record['tree'], **kwargs)
+    os.unlink(_record_path(name, state_dir))
+    return retained
+
+
+def run():
+    import argparse
+    import sys
+    from . import replaceparser
+    from .list_processes import collect_process_info
+    from .locking import add_lock_arguments, locks_from_opts
+    from .canned_command_runner import (root_fd, canned_mount_cmd,
+                                        canned_umount_cmd, canned_findmnt_cmd)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--state-dir', default=default_state_dir)
+    ap.add_argument('--pid', type=int, default=os.getpid(),
+                    help='Stage for the mount namespace of this process')
+    add_lock_arguments(ap)
+    subparsers = ap.add_subparsers(dest='command')
+    stage_ap = subparsers.add_parser('stage', help='Build a new tree')
+    stage_ap.add_argument('--name', default=None)
+    stage_ap.add_argument('--root', default='/')
+    replaceparser.extend_arg_parser(stage_ap)
+    subparsers.add_parser('list', help='List staged trees')
+    discard_ap = subparsers.add_parser('discard', help='Remove a staged tree')
+    discard_ap.add_argument('name')
+    switch_ap = subparsers.add_parser('switch',
+                                      help='Migrate to a staged tree')
+    switch_ap.add_argument('name')
+    switch_ap.add_argument('--force', action='store_true', default=False,
+                           help='Switch even if mounts have changed')
+    opts = ap.parse_args()
+
+    if opts.command == 'list':
+        for record in list_staged(state_dir=opts.state_dir):
+            print('%(name)s\t%(namespace)d\t%(root)s\t%(tree)s\t%(mounts)d'
+                  % record)
+        return
+
+    with NamespacePool() as pool, \
+         root_fd() as root_fdno, \
+         canned_mount_cmd(root_fdno) as mount_cmd, \
+         canned_umount_cmd(root_fdno) as umount_cmd, \
+         canned_findmnt_cmd(root_fdno) as findmnt_cmd:
+        namespace = pool.get(opts.pid)
+        locks = locks_from_opts(opts)
+        if opts.command == 'stage':
+            stage_tree(namespace, opts.root, opts.replace, name=opts.name,
+                       state_dir=opts.state_dir, mount_cmd=mount_cmd,
+                       umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                       locks=locks)
+        elif opts.command == 'discard':
+            discard_staged(namespace, opts.name, state_dir=opts.state_dir,
+                           umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd)
+        elif opts.command == 'switch':
+            record = _load_record(opts.name, opts.state_dir)
+            procinfo = collect_process_info(
+                pool=pool, pids=pids_in_namespaces([namespace.inode]))
+            pids = procinfo[namespace].get(record['root'], set())
+            switch_staged(namespace, opts.name, pids,
+                          state_dir=opts.state_dir, mount_cmd=mount_cmd,
+                          umount_cmd=umount_cmd, findmnt_cmd=findmnt_cmd,
+                          force=opts.force, locks=locks,
+                          caps=CapabilityCache())
+
+
+if __name__ == '__main__':
+    run()
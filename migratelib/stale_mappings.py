@@ -0,0 +1,287 @@
+#!/usr/bin/python
+#
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Find processes still mapping files from an old root.
+
+A migrated process keeps the executable and libraries it had mapped, which
+keeps the old tree and its page cache alive until the process restarts. A
+mapping is stale if the file at its path in the process' current root is
+not the same device and inode as the mapped file, taking the device from
+the mount table, as maps does, rather than stat.
+
+Every process' maps are read in parallel, and smaps is only read for those
+with stale mappings, to find how much memory restarting them would free.
+
+'''
+
+
+import collections
+import errno
+import logging
+import os
+from multiprocessing import Pool
+
+
+__all__ = ('find_stale_mappings', 'scan_stale_mappings', 'stale_by_service')
+
+
+StaleProcess = collections.namedtuple('StaleProcess', (
+    'pid', 'comm', 'service', 'files', 'rss', 'pss'))
+
+
+# Shared memory shows up as deleted files, but was never in a root
+_shared_memory_prefixes = ('/dev/shm/', '/memfd:', '/SYSV')
+
+
+def _parse_maps(maps):
+    '''Yield (range, device, inode, path) for every file mapping in `maps`.
+
+    `device` is a (major, minor) pair.
+
+    '''
+    for line in maps:
+        # address perms offset dev inode path
+        fields = line.split(None, 5)
+        if len(fields) < 6 or fields[4] == '0':
+            continue
+        major, minor = fields[3].split(':')
+        yield (fields[0], (int(major, 16), int(minor, 16)), int(fields[4]),
+               fields[5].rstrip('\n'))
+
+
+def _pid_service(pid):
+    '''Return the systemd unit, or failing that the cgroup, of `pid`.'''
+    cgroup = None
+    with open(os.path.join('/proc', str(pid), 'cgroup')) as f:
+        for line in f:
+            hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+            # The unified hierarchy, or systemd's own on cgroup v1
+            if controllers in ('', 'name=systemd'):
+                cgroup = path
+    if cgroup is None:
+        return None
+    for component in reversed(cgroup.split('/')):
+        if component.endswith(('.service', '.scope')):
+            return component
+    return cgroup
+
+
+O_PATH = 010000000
+O_CLOEXEC = 02000000
+
+
+# Mapped libraries are shared by most processes, so each worker remembers
+# what their paths resolve to, keyed by mount namespace and root
+_resolved = {}
+
+# Devices of the mounts seen by each mount namespace and root, by mount ID
+_mount_devices = {}
+
+
+def _read_mount_devices(pid):
+    devices = {}
+    with open(os.path.join('/proc', str(pid), 'mountinfo')) as f:
+        for line in f:
+            # mount_id parent_id major:minor root target ...
+            fields = line.split(None, 3)
+            major, minor = fields[2].split(':')
+            devices[int(fields[0])] = (int(major), int(minor))
+    return devices
+
+
+def _mount_id(fd):
+    with open('/proc/self/fdinfo/%d' % fd) as f:
+        for line in f:
+            if line.startswith('mnt_id:'):
+                return int(line.split()[1])
+    raise ValueError('No mount ID for fd %d' % fd)
+
+
+def _mount_device(pid, ns_inode, root, mount_id):
+    key = (ns_inode, root)
+    devices = _mount_devices.get(key)
+    if devices is None or mount_id not in devices:
+        # Mounted since it was last read
+        devices = _mount_devices[key] = _read_mount_devices(pid)
+    return devices.get(mount_id)
+
+
+def _resolve(pid, ns_inode, root, path):
+    key = (ns_inode, root, path)
+    if key not in _resolved:
+        # maps shows paths from our root, the process needs them from its own
+        if root != '/' and path.startswith(root + '/'):
+            path = path[len(root):]
+        try:
+            fd = os.open(os.path.join('/proc', str(pid), 'root',
+                                      path.lstrip('/')), O_PATH | O_CLOEXEC)
+        except OSError:
+            _resolved[key] = None
+            return None
+        try:
+            # maps has the device of the superblock, which stat doesn't for
+            # btrfs subvolumes or overlayfs, but the mount table does
+            _resolved[key] = (_mount_device(pid, ns_inode, root,
+                                            _mount_id(fd)),
+                              os.fstat(fd).st_ino)
+        finally:
+            os.close(fd)
+    return _resolved[key]
+
+
+def _smaps_usage(pid, ranges):
+    '''Sum the Rss and Pss in kB of the mappings of `pid` in `ranges`.'''
+    rss = pss = 0
+    counting = False
+    with open(os.path.join('/proc', str(pid), 'smaps')) as smaps:
+        for line in smaps:
+            field = line.split(None, 1)[0]
+            if not field.endswith(':'):
+                # A mapping header rather than a field of one
+                counting = field in ranges
+            elif counting and field == 'Rss:':
+                rss += int(line.split()[1])
+            elif counting and field == 'Pss:':
+                pss += int(line.split()[1])
+    return rss, pss
+
+
+def find_stale_mappings(pid):
+    '''Return a StaleProcess for `pid`, or None if it maps nothing stale.'''
+    proc_path = os.path.join('/proc', str(pid))
+    try:
+        root = os.readlink(os.path.join(proc_path, 'root'))
+        ns_inode = os.stat(os.path.join(proc_path, 'ns', 'mnt')).st_ino
+        files = set()
+        ranges = set()
+        with open(os.path.join(proc_path, 'maps')) as maps:
+            for address, device, inode, path in _parse_maps(maps):
+                if (not path.startswith('/')
+                    or path.startswith(_shared_memory_prefixes)):
+                    continue
+                if path.endswith(' (deleted)'):
+                    stale = True
+                else:
+                    stale = (_resolve(pid, ns_inode, root, path)
+                             != (device, inode))
+                if stale:
+                    files.add(path)
+                    ranges.add(address)
+        if not ranges:
+            return None
+        rss, pss = _smaps_usage(pid, ranges)
+        with open(os.path.join(proc_path, 'comm')) as f:
+            comm = f.read().rstrip('\n')
+        return StaleProcess(pid=pid, comm=comm, service=_pid_service(pid),
+                            files=sorted(files), rss=rss, pss=pss)
+    except (IOError, OSError) as e:
+        # Exited, a kernel thread, or not ours to look at
+        if e.errno not in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+            raise
+        return None
+
+
+def _all_pids():
+    return [int(entry) for entry in os.listdir('/proc') if entry.isdigit()]
+
+
+def scan_stale_mappings(pids=None, workers=None):
+    '''Return StaleProcesses for `pids`, most memory to free first.
+
+    If `pids` is None then every process is scanned. `workers` processes
+    are used, by default one per CPU. Processes rather than threads are
+    used, as parsing is CPU-bound, and so the caller can still enter other
+    mount namespaces.
+
+    '''
+    if pids is None:
+        pids = _all_pids()
+    pool = Pool(processes=workers)
+    try:
+        stale = [process for process
+                 in pool.imap_unordered(find_stale_mappings, pids,
+                                        chunksize=64)
+                 if process is not None]
+    finally:
+        pool.close()
+        pool.join()
+    stale.sort(key=lambda process: process.pss, reverse=True)
+    return stale
+
+
+def stale_by_service(stale):
+    '''Group StaleProcesses by service, most memory to free first.
+
+    Returns a list of (service, pss, pids) tuples. Pss is used rather than
+    Rss since it can be summed over processes sharing the same pages.
+
+    '''
+    services = collections.defaultdict(lambda: [0, []])
+    for process in stale:
+        services[process.service][0] += process.pss
+        services[process.service][1].append(process.pid)
+    return sorted(((service, pss, sorted(pids))
+                   for service, (pss, pids) in services.iteritems()),
+                  key=lambda entry: entry[1], reverse=True)
+
+
+def run():
+    import argparse
+    import json
+    import sys
+    from .list_processes import add_scope_arguments, select_pids_from_opts
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--workers', type=int, default=None,
+                    help='Processes to scan with, default one per CPU')
+    ap.add_argument('--top', type=int, default=None,
+                    help='Only list this many services and processes')
+    ap.add_argument('--json', action='store_true', default=False,
+                    help='Output a JSON object rather than tables')
+    add_scope_arguments(ap)
+    opts = ap.parse_args()
+
+    selected = select_pids_from_opts(opts)
+    stale = scan_stale_mappings(
+        pids=sorted(selected) if selected is not None else None,
+        workers=opts.workers)
+    services = stale_by_service(stale)
+    if opts.json:
+        json.dump({'services': [{'service': service, 'pss': pss,
+                                 'pids': pids}
+                                for service, pss, pids
+                                in services[:opts.top]],
+                   'processes': [process._asdict()
+                                 for process in stale[:opts.top]]},
+                  sys.stdout)
+        sys.stdout.write('\n')
+        return
+    print('%10s  %s' % ('PSS kB', 'SERVICE'))
+    for service, pss, pids in services[:opts.top]:
+        print('%10d  %s (%d processes)' % (pss, service, len(pids)))
+    print('')
+    print('%10s  %10s  %7s  %s' % ('PSS kB', 'RSS kB', 'PID', 'COMMAND'))
+    for process in stale[:opts.top]:
+        print('%10d  %10d  %7d  %s, %d stale files'
+              % (process.pss, process.rss, process.pid, process.comm,
+                 len(process.files)))
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,283 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Choose how to build and tear down mount trees on this host.
+
+Bind mounts, which are most of a new tree, can be made by:
+
+syscall
+    mount(2) from this process.
+open-tree
+    Cloning with open_tree(2) and attaching the clone with move_mount(2).
+command
+    The mount_cmd that was passed in, which may be a canned command.
+
+Other mounts always use mount_cmd, as they may need mount(8)'s option
+parsing or helpers. Teardown is by umount2(2) from this process, or by
+umount_cmd.
+
+Which methods work is probed once per mount namespace, since privileges and
+kernel features can differ between them. Which works best is decided from
+how long each took per mount in earlier runs with a similar number of
+mounts, which a TreeStrategy loads from and saves to a history file. If a
+method fails part way through a tree and the next one works where it
+failed, the rest of the tree is built with that, and the failed one isn't
+chosen again for trees of that size until the history is removed, which a
+reboot does for the default one in /run.
+
+'''
+
+
+import errno
+import json
+import logging
+import math
+import os
+
+from .genmounts import BindMount
+from .ll.mount import mount, umount2, MS_BIND, MS_REC, MNT_DETACH
+from .ll.open_tree import (open_tree, move_mount, AT_RECURSIVE,
+                           OPEN_TREE_CLONE, OPEN_TREE_CLOEXEC)
+
+
+__all__ = ('TreeStrategy', 'TreeBuilder', 'construction_methods')
+
+
+default_history_path = '/run/migratelib/strategy.json'
+
+# In order of preference when nothing has been timed
+construction_methods = ('syscall', 'open-tree', 'command')
+
+# Weight of the latest run in a method's average cost
+_new_weight = 0.3
+
+
+def _size_bucket(mount_count):
+    # Trees within a factor of two in size cost about the same per mount
+    return str(2 ** int(math.ceil(math.log(max(mount_count, 1), 2))))
+
+
+def _namespace_inode():
+    return os.stat('/proc/self/ns/mnt').st_ino
+
+
+def _bind_flags(mountargs):
+    if 'rbind' in mountargs.options:
+        return MS_BIND | MS_REC
+    return MS_BIND
+
+
+def _is_bind(mountargs):
+    return (mountargs.type is None
+            and tuple(mountargs.options) in (('bind',), ('rbind',)))
+
+
+def _syscall_mount(mountargs):
+    mount(mountargs.source, mountargs.target, flags=_bind_flags(mountargs))
+
+
+def _open_tree_mount(mountargs):
+    flags = OPEN_TREE_CLONE | OPEN_TREE_CLOEXEC
+    if 'rbind' in mountargs.options:
+        flags |= AT_RECURSIVE
+    tree_fd = open_tree(mountargs.source, flags)
+    try:
+        move_mount(tree_fd, mountargs.target)
+    finally:
+        os.close(tree_fd)
+
+
+_binders = {'syscall': _syscall_mount, 'open-tree': _open_tree_mount}
+
+
+class TreeBuilder(object):
+    '''mount_cmd and umount_cmd for a MountTree, using the chosen methods.
+
+    `method` is the construction method in use, which changes if one fails
+    and the next is fallen back to, and `teardown` is 'syscall' or
+    'command'.
+
+    '''
+    def __init__(self, methods, teardown, reason, mount_cmd, umount_cmd):
+        self.methods = list(methods)
+        self.method = self.methods[0]
+        self.teardown = teardown
+        self.reason = reason
+        self.failed = []
+        self.fallback_mount_cmd = mount_cmd
+        self.fallback_umount_cmd = umount_cmd
+
+    def mount_cmd(self, mountargs):
+        if not _is_bind(mountargs):
+            return self.fallback_mount_cmd(mountargs)
+        failed = []
+        error = None
+        for method in self.methods:
+            try:
+                if method == 'command':
+                    result = self.fallback_mount_cmd(mountargs)
+                else:
+                    result = _binders[method](mountargs)
+                break
+            except OSError as e:
+                if method == 'command':
+                    raise
+                logging.warning('Mounting %s with %s failed: %s'
+                                % (mountargs.target, method, e))
+                failed.append(method)
+                error = e
+        else:
+            raise error
+        # Only blame methods for errors the one that worked didn't hit,
+        # not for a missing source or an unbindable mount
+        if failed:
+            logging.warning('Mounted %s with %s, using it from now on'
+                            % (mountargs.target, method))
+            self.failed.extend(failed)
+            del self.methods[:len(failed)]
+            self.method = method
+        return result
+
+    def umount_cmd(self, target, detach=False):
+        if self.teardown == 'syscall':
+            try:
+                return umount2(target, MNT_DETACH if detach else 0)
+            except OSError as e:
+                logging.warning('Unmounting %s failed: %s, falling back to '
+                                'umount_cmd' % (target, e))
+                self.teardown = 'command'
+        return self.fallback_umount_cmd(target, detach=detach)
+
+
+class TreeStrategy(object):
+    '''Choose TreeBuilders, from probes and the timings in `history_path`.
+
+    The history is read when this is made and written by `save()`, which
+    should be done outside the namespaces being migrated, as those may
+    have their own /run.
+
+    If `methods` is given, only those construction methods are considered.
+
+    '''
+    def __init__(self, history_path=default_history_path,
+                 methods=construction_methods):
+        self.history_path = history_path
+        self.methods = [method for method in construction_methods
+                        if method in methods]
+        if 'command' not in self.methods:
+            # Needed for mounts that aren't binds, and as a last resort
+            self.methods.append('command')
+        self.probed = {} # namespace inode -> {method: reason unavailable}
+        self.history = {}
+        try:
+            with open(history_path) as f:
+                self.history = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            logging.warning('Ignoring unreadable strategy history in %s'
+                            % history_path)
+
+    def _probe(self, scratch_dir):
+        '''Return why methods can't be used here, trying them on a
+        directory bound onto itself.'''
+        unavailable = {}
+        for method in ('syscall', 'open-tree'):
+            if method not in self.methods:
+                continue
+            bind = BindMount(source=scratch_dir, target=scratch_dir)
+            try:
+                _binders[method](bind)
+            except OSError as e:
+                unavailable[method] = e.strerror
+                continue
+            try:
+                umount2(scratch_dir, MNT_DETACH)
+            except OSError as e:
+                unavailable['umount2'] = e.strerror
+        return unavailable
+
+    def choose(self, scratch_dir, mount_count, mount_cmd, umount_cmd):
+        '''Return a TreeBuilder for a tree of `mount_count` mounts.
+
+        `scratch_dir` is an empty directory that may be mounted on to probe
+        what works, such as the root of the new tree. `mount_cmd` and
+        `umount_cmd` are what the builder falls back to.
+
+        '''
+        inode = _namespace_inode()
+        if inode not in self.probed:
+            self.probed[inode] = self._probe(scratch_dir)
+        unavailable = self.probed[inode]
+        candidates = [method for method in self.methods
+                      if method not in unavailable]
+        timings = self.history.get(_size_bucket(mount_count), {})
+        ok = dict((method, timings[method]) for method in candidates
+                  if method in timings and not timings[method]['failed'])
+        best = min(ok, key=lambda method: ok[method]['per_mount']) \
+               if ok else None
+        for method in candidates:
+            if method == best:
+                reason = ('cheapest at %.2fms per mount for trees of up to '
+                          '%s mounts' % (ok[method]['per_mount'] * 1000,
+                                         _size_bucket(mount_count)))
+                break
+            if method not in timings:
+                reason = ('not yet timed for trees of up to %s mounts'
+                          % _size_bucket(mount_count))
+                break
+        else:
+            method = candidates[0]
+            reason = 'every other method failed before'
+        if unavailable:
+            reason += '; unavailable: %s' % ', '.join(
+                '%s (%s)' % pair for pair in sorted(unavailable.iteritems()))
+        teardown = 'command' if 'umount2' in unavailable \
+                   or 'syscall' in unavailable else 'syscall'
+        logging.info('Building a tree of %d mounts with %s: %s'
+                     % (mount_count, method, reason))
+        return TreeBuilder(candidates[candidates.index(method):], teardown,
+                           reason, mount_cmd, umount_cmd)
+
+    def record(self, builder, mount_count, duration):
+        '''Record that `builder` built `mount_count` mounts in `duration`.'''
+        timings = self.history.setdefault(_size_bucket(mount_count), {})
+        for method in builder.failed:
+            timings.setdefault(method, {'per_mount': None, 'runs': 0})
+            timings[method]['failed'] = True
+        if builder.failed or mount_count == 0:
+            # Time spent on a failed method isn't the fallback's cost
+            return
+        per_mount = duration / mount_count
+        timing = timings.get(builder.method)
+        if timing is None or timing['per_mount'] is None:
+            timings[builder.method] = {'per_mount': per_mount, 'runs': 1,
+                                       'failed': False}
+        else:
+            timing['per_mount'] += _new_weight * (per_mount
+                                                  - timing['per_mount'])
+            timing['runs'] += 1
+            timing['failed'] = False
+
+    def save(self):
+        directory = os.path.dirname(self.history_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = '%s.%d' % (self.history_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(self.history, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self.history_path)
@@ -0,0 +1,169 @@
+# Copyright (C) 2014 Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Check that migrated processes really are in the new tree.
+
+The root, cwd and directory fds of each process are compared with where
+migrate_process should have put them, by mount ID, device and inode rather
+than by path. A bind mount has the same device and inode as what it
+copies, so only the mount ID can tell the old tree's /home from the new
+tree's.
+
+'''
+
+
+import collections
+import errno
+import logging
+import os
+from multiprocessing import Pool
+
+from .migrate_process import get_pid_starttime
+
+
+__all__ = ('Verification', 'verify_processes', 'verify_and_requeue')
+
+
+O_PATH = 010000000
+O_DIRECTORY = 0200000
+
+# Starting a pool costs more than checking this many processes here
+_pool_threshold = 64
+
+
+# `stragglers` maps the pid of each process not entirely in the new tree to
+# what isn't, such as ('root', 'cwd', 'fd 3')
+Verification = collections.namedtuple('Verification',
+                                      'checked exited stragglers')
+
+
+def _mount_id(fd):
+    with open('/proc/self/fdinfo/%d' % fd) as f:
+        for line in f:
+            if line.startswith('mnt_id:'):
+                return int(line.split()[1])
+    # Too old a kernel to say
+    return None
+
+
+def _identity(path):
+    '''Return the (mount ID, device, inode) of the directory at `path`.'''
+    fd = os.open(path, O_PATH | O_DIRECTORY)
+    try:
+        st = os.fstat(fd)
+        return _mount_id(fd), st.st_dev, st.st_ino
+    finally:
+        os.close(fd)
+
+
+def _expected(record, new_root):
+    '''Yield what to check in a migrated process, and where it should be.'''
+    yield 'root', '/proc/%d/root' % record['pid'], record['new_root']
+    yield ('cwd', '/proc/%d/cwd' % record['pid'],
+           os.path.join(new_root, record['old_cwd'].lstrip('/')))
+    for fileno, path in record['old_dir_fds']:
+        yield ('fd %d' % fileno, '/proc/%d/fd/%d' % (record['pid'], fileno),
+               os.path.join(new_root, path.lstrip('/')))
+
+
+def verify_process(item):
+    '''Return (pid, problems) for a (record, new_root) pair.
+
+    `problems` is None if the process has exited, and otherwise names the
+    parts of it that aren't in `new_root`, or that we may not look at.
+
+    '''
+    record, new_root = item
+    pid = record['pid']
+    problems = []
+    try:
+        if get_pid_starttime(pid) != record['starttime']:
+            return pid, None
+        for name, actual, expected in _expected(record, new_root):
+            try:
+                if _identity(actual) != _identity(expected):
+                    problems.append(name)
+            except OSError as e:
+                if e.errno == errno.EACCES:
+                    problems.append('%s (unreadable)' % name)
+                    continue
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                # The fd was closed, or what it should be is missing
+                problems.append(name)
+        # Exiting part way through checking looks like missing fds
+        if get_pid_starttime(pid) != record['starttime']:
+            return pid, None
+    except (IOError, OSError) as e:
+        if e.errno in (errno.ENOENT, errno.ESRCH):
+            return pid, None
+        if e.errno != errno.EACCES:
+            raise
+        # Such as when it changed credentials, so can't be checked
+        problems.append('unreadable')
+    return pid, tuple(problems)
+
+
+def verify_processes(records, new_root, workers=None):
+    '''Check that processes migrated to `new_root` are all in it.
+
+    `records` are the values returned by migrate_process. Many processes
+    are checked by a pool of `workers` processes, by default one per CPU.
+
+    '''
+    items = [(record, new_root) for record in records]
+    if len(items) < _pool_threshold or workers == 1:
+        results = map(verify_process, items)
+    else:
+        pool = Pool(processes=workers)
+        try:
+            results = list(pool.imap_unordered(verify_process, items,
+                                               chunksize=16))
+        finally:
+            pool.close()
+            pool.join()
+    exited = [pid for pid, problems in results if problems is None]
+    stragglers = dict((pid, problems) for pid, problems in results
+                      if problems)
+    return Verification(checked=len(results), exited=exited,
+                        stragglers=stragglers)
+
+
+def verify_and_requeue(records, new_root, migrate, requeue=1, workers=None):
+    '''Verify processes, migrating stragglers again up to `requeue` times.
+
+    `records` maps pids to their migrate_process records. `migrate` is
+    called with the record of each straggler, and should move it again and
+    return its new record, or None if it couldn't. Returns the final
+    Verification.
+
+    '''
+    records = dict(records)
+    for attempt in xrange(requeue + 1):
+        verification = verify_processes(records.itervalues(), new_root,
+                                        workers=workers)
+        if not verification.stragglers or attempt == requeue:
+            break
+        for pid, problems in sorted(verification.stragglers.iteritems()):
+            logging.info('Migrating pid %d again, as its %s not in the new '
+                         'tree' % (pid, ', '.join(problems)))
+            record = migrate(records[pid])
+            if record is not None:
+                records[pid] = record
+    for pid, problems in sorted(verification.stragglers.iteritems()):
+        logging.warning('Pid %d is not entirely in the new tree: %s'
+                        % (pid, ', '.join(problems)))
+    return verification